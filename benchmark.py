@@ -0,0 +1,156 @@
+###############################################################################
+# Event Detection Algorithm Suite
+#  Copyright (C) 2012 Gian Perrone (http://github.com/gian)
+#  
+#  Permission to use, copy, modify, and distribute this software and its
+#  documentation for any purpose and without fee is hereby granted,
+#  provided that the above copyright notice appear in all copies and that
+#  both the copyright notice and this permission notice and warranty
+#  disclaimer appear in supporting documentation, and that the name of
+#  the above copyright holders, or their entities, not be used in
+#  advertising or publicity pertaining to distribution of the software
+#  without specific, written prior permission.
+#  
+#  The above copyright holders disclaim all warranties with regard to
+#  this software, including all implied warranties of merchantability and
+#  fitness. In no event shall the above copyright holders be liable for
+#  any special, indirect or consequential damages or any damages
+#  whatsoever resulting from loss of use, data or profits, whether in an
+#  action of contract, negligence or other tortious action, arising out
+#  of or in connection with the use or performance of this software.
+###############################################################################
+
+# Throughput and memory benchmark for the filters and detectors in detect/.
+#
+#   python benchmark.py [size ...]
+#
+# Each stage is run over synthetic recordings of each size (default 10^4,
+# 10^5 and 10^6 samples at 500 Hz), once reading Sample objects one at a
+# time and once in block mode.  Every run happens in a forked child, so
+# the peak memory (ru_maxrss) is that run's alone; it is reported as the
+# growth over the prepared input.  WeightedFilter is left out, as it
+# cannot be run on its own yet.
+
+import os
+import sys
+import time
+import resource
+import cPickle
+
+from detect.sample import ListSampleStream
+from detect.synth import synthesize
+
+from detect.blinkfilter import *
+from detect.movingaverage import *
+from detect.noisefilter import *
+from detect.intersamplevelocity import *
+from detect.sgfilter import *
+from detect.velocity import *
+from detect.dispersion import *
+from detect.hmm import *
+from detect.aoi import *
+from detect.srr import *
+from detect.engbertkliegl import *
+from detect.smeetshooge import *
+
+rate = 500.0
+pixelsPerDegree = 35.0
+screen = (1024, 768)
+
+# Velocities are in pixels/s, as timestamps are in seconds.
+saccadeVelocity = 30 * pixelsPerDegree
+
+# A grid of 8x6 areas of interest over the screen.
+areas = [(x, y, x + screen[0] / 8 - 1, y + screen[1] / 6 - 1)
+         for x in range(0, screen[0], screen[0] / 8)
+         for y in range(0, screen[1], screen[1] / 6)]
+
+# (name, input, constructor).  Filters take the raw recording; the
+# other stages take it with blinks removed and velocities attached.
+stages = [
+	('BlinkFilter', 'raw', lambda s: BlinkFilter(s)),
+	('MovingAverageFilter', 'raw', lambda s: MovingAverageFilter(s, 9)),
+	('NoiseFilter', 'raw', lambda s: NoiseFilter(s, 1.0)),
+	('IntersampleVelocity', 'raw', lambda s: IntersampleVelocity(s)),
+	('SGFilter', 'velocity', lambda s: SGFilter(s, 9, 2)),
+	('Velocity', 'velocity', lambda s: Velocity(s, saccadeVelocity)),
+	('Dispersion', 'velocity', lambda s: Dispersion(s, int(rate * 0.05), pixelsPerDegree)),
+	('HMM', 'velocity', lambda s: HMM(s, 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1)),
+	('AOI', 'velocity', lambda s: AOI(s, int(rate * 0.05), areas)),
+	('SRR', 'velocity', lambda s: SRR(s, 3, saccadeVelocity, 8000 * pixelsPerDegree, 2)),
+	('EngbertKliegl', 'velocity', lambda s: EngbertKliegl(s, 6)),
+	('SmeetsHooge', 'velocity', lambda s: SmeetsHooge(s, saccadeVelocity, 20, 5)),
+]
+
+def inForkedChild(run):
+	"""Run a function in a forked child, returning its result."""
+	(r, w) = os.pipe()
+	pid = os.fork()
+
+	if pid == 0:
+		os.close(r)
+		try:
+			result = run()
+		except Exception, e:
+			result = "%s: %s" % (type(e).__name__, e)
+		os.write(w, cPickle.dumps(result))
+		os._exit(0)
+
+	os.close(w)
+	data = []
+	while True:
+		chunk = os.read(r, 65536)
+		if not chunk:
+			break
+		data.append(chunk)
+	os.close(r)
+	os.waitpid(pid, 0)
+
+	return cPickle.loads("".join(data))
+
+def peakKB():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def perSample(make, block):
+	samples = list(block.samples())
+	stage = make(ListSampleStream(samples))
+
+	before = peakKB()
+	start = time.time()
+	count = 0
+	for out in stage:
+		count = count + 1
+	elapsed = time.time() - start
+
+	return (elapsed, count, peakKB() - before)
+
+def blockMode(make, block):
+	stage = make(None)
+
+	before = peakKB()
+	start = time.time()
+	count = len(stage.processBlock(block))
+	elapsed = time.time() - start
+
+	return (elapsed, count, peakKB() - before)
+
+sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+
+print "%-20s %-10s %9s %14s %9s %9s" % ("stage", "mode", "samples", "samples/s", "output", "peak +MB")
+
+for n in sizes:
+	raw = synthesize(n, rate=rate, seed=n, timeScale=1.0, screen=screen, pixelsPerDegree=pixelsPerDegree)
+	inputs = {'raw': raw, 'velocity': IntersampleVelocity(None).processBlock(BlinkFilter(None).processBlock(raw))}
+
+	for (name, kind, make) in stages:
+		block = inputs[kind]
+		for (mode, run) in (('per-sample', perSample), ('block', blockMode)):
+			result = inForkedChild(lambda: run(make, block))
+
+			if isinstance(result, str):
+				print "%-20s %-10s %9d %s" % (name, mode, len(block), result)
+			else:
+				(elapsed, count, kb) = result
+				print "%-20s %-10s %9d %14.0f %9d %9.1f" % (name, mode, len(block),
+					len(block) / max(elapsed, 1e-9), count, kb / 1024.0)
+			sys.stdout.flush()
@@ -23,30 +23,325 @@
 from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
+from eventstream import EventTable
+
+import bisect
+import math
+import numpy as np
+
+class Polygon(object):
+	"""A polygonal area of interest, from a list of (x, y) vertices.
+
+	   As with the edges of rectangular areas, points on the boundary
+	   count as inside.  Polygons compare by identity, so the same object
+	   should be used wherever the same area is meant.
+	"""
+	def __init__(self, vertices):
+		self.vertices = [tuple(v) for v in vertices]
+		if len(self.vertices) < 3:
+			raise ValueError("a polygon needs at least three vertices")
+
+		v = np.array(self.vertices, dtype=float)
+		self.xs = v[:, 0]
+		self.ys = v[:, 1]
+
+	def bounds(self):
+		return (self.xs.min(), self.ys.min(), self.xs.max(), self.ys.max())
+
+	def edges(self):
+		prev = self.vertices[-1]
+		for curr in self.vertices:
+			yield (prev, curr)
+			prev = curr
+
+	def contains(self, x, y):
+		""" Test a single point, by counting edge crossings. """
+		inside = False
+
+		for ((x0, y0), (x1, y1)) in self.edges():
+			if (x1 - x0) * (y - y0) == (y1 - y0) * (x - x0) and \
+			   min(x0, x1) <= x <= max(x0, x1) and min(y0, y1) <= y <= max(y0, y1):
+				return True
+
+			if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / float(y1 - y0):
+				inside = not inside
+
+		return inside
+
+	def containsPoints(self, x, y):
+		""" Test arrays of points, as contains() does. """
+		inside = np.zeros(len(x), dtype=bool)
+		edge = np.zeros(len(x), dtype=bool)
+
+		for ((x0, y0), (x1, y1)) in self.edges():
+			edge |= (((x1 - x0) * (y - y0) == (y1 - y0) * (x - x0)) &
+			         (x >= min(x0, x1)) & (x <= max(x0, x1)) &
+			         (y >= min(y0, y1)) & (y <= max(y0, y1)))
+
+			if y0 != y1:
+				straddle = (y0 > y) != (y1 > y)
+				inside ^= straddle & (x < x0 + (y - y0) * (x1 - x0) / float(y1 - y0))
+
+		return inside | edge
+
+class AreaIndex(object):
+	"""A uniform grid over a list of areas of interest, built once, for
+	   finding the area a point is in.
+
+	   Each cell lists the areas whose bounding boxes overlap it, in list
+	   order, and candidates are tested exactly, so a point gets the first
+	   area in the list that contains it, as a linear scan would find.
+	   Cells are about the size of a typical area, so a lookup tests only
+	   a few areas however many there are.
+
+	   Areas are (upperLeftX,upperLeftY,lowerRightX,lowerRightY) tuples,
+	   edges included, or Polygons, which are entered into the grid by
+	   their bounding boxes.
+	"""
+	maxCells = 1 << 20
+
+	def __init__(self, areas):
+		self.areas = list(areas)
+		self.bounds = np.array([self.areaBounds(a) for a in self.areas], dtype=float).reshape(-1, 4)
+		self.polygons = np.array([isinstance(a, Polygon) for a in self.areas], dtype=bool)
+		b = self.bounds
+
+		if len(b) == 0:
+			self.origin = (0.0, 0.0)
+			self.cellSize = (1.0, 1.0)
+			self.shape = (0, 0)
+			self.cellStart = np.zeros(1, dtype=np.intp)
+			self.cellAreas = np.zeros(0, dtype=np.intp)
+			return
+
+		self.origin = (b[:, 0].min(), b[:, 1].min())
+		span = (b[:, 2].max() - self.origin[0], b[:, 3].max() - self.origin[1])
+
+		# Cells the size of the median area, within the cell budget.
+		size = [np.median(b[:, 2] - b[:, 0]), np.median(b[:, 3] - b[:, 1])]
+		for d in (0, 1):
+			if size[d] <= 0:
+				size[d] = max(span[d], 1.0)
+			size[d] = max(size[d], span[d] / math.sqrt(self.maxCells))
+		self.cellSize = tuple(size)
+		self.shape = (int(span[0] // size[0]) + 1, int(span[1] // size[1]) + 1)
+
+		# The cells each area's bounding box covers.
+		(c0, r0) = self.cellOf(b[:, 0], b[:, 1])
+		(c1, r1) = self.cellOf(b[:, 2], b[:, 3])
+
+		cells = []
+		owners = []
+		for a in range(len(b)):
+			(cols, rows) = np.meshgrid(np.arange(c0[a], c1[a] + 1), np.arange(r0[a], r1[a] + 1))
+			cells.append((rows * self.shape[0] + cols).ravel())
+			owners.append(np.full(cells[-1].shape, a, dtype=np.intp))
+		cells = np.concatenate(cells)
+		owners = np.concatenate(owners)
+
+		# Compressed rows: the areas in cell c are
+		# cellAreas[cellStart[c]:cellStart[c + 1]], in list order.
+		order = np.lexsort((owners, cells))
+		self.cellAreas = owners[order]
+		counts = np.bincount(cells, minlength=self.shape[0] * self.shape[1])
+		self.cellStart = np.concatenate(([0], np.cumsum(counts)))
+
+	def areaBounds(self, area):
+		if isinstance(area, Polygon):
+			return area.bounds()
+		return area
+
+	def cellOf(self, x, y):
+		""" The column and row of the cells holding points, which must be
+		    within the grid. """
+		col = np.floor((np.asarray(x, dtype=float) - self.origin[0]) / self.cellSize[0]).astype(np.intp)
+		row = np.floor((np.asarray(y, dtype=float) - self.origin[1]) / self.cellSize[1]).astype(np.intp)
+		return (np.minimum(col, self.shape[0] - 1), np.minimum(row, self.shape[1] - 1))
+
+	def contains(self, a, x, y):
+		""" Exact test of a point against area a. """
+		area = self.areas[a]
+		if isinstance(area, Polygon):
+			return area.contains(x, y)
+
+		(ulx, uly, lrx, lry) = area
+		return x >= ulx and x <= lrx and y >= uly and y <= lry
+
+	def containsPoints(self, a, x, y):
+		""" Exact test of points against areas a (one per point). """
+		(ulx, uly, lrx, lry) = self.bounds[a].T
+		hit = (x >= ulx) & (x <= lrx) & (y >= uly) & (y <= lry)
+
+		# Points within a polygon's bounding box need the full test.
+		poly = np.flatnonzero(hit & self.polygons[a])
+		if len(poly):
+			poly = poly[np.argsort(a[poly], kind='mergesort')]
+			ids = a[poly]
+			cuts = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+			for m in np.split(poly, cuts):
+				hit[m] = self.areas[a[m[0]]].containsPoints(x[m], y[m])
+
+		return hit
+
+	def lookup(self, x, y, t=None):
+		""" The index of the first area containing (x, y), or None.  The
+		    time is ignored, as the areas are fixed. """
+		if len(self.bounds) == 0:
+			return None
+
+		col = int(math.floor((x - self.origin[0]) / self.cellSize[0]))
+		row = int(math.floor((y - self.origin[1]) / self.cellSize[1]))
+		if col < 0 or row < 0 or col > self.shape[0] or row > self.shape[1]:
+			return None
+		cell = min(row, self.shape[1] - 1) * self.shape[0] + min(col, self.shape[0] - 1)
+
+		for a in self.cellAreas[self.cellStart[cell]:self.cellStart[cell + 1]].tolist():
+			if self.contains(a, x, y):
+				return a
+
+		return None
+
+	def labels(self, x, y, t=None):
+		""" Label arrays of points with the index of the first area that
+		    contains each, or -1.  The times are ignored. """
+		x = np.asarray(x, dtype=float)
+		y = np.asarray(y, dtype=float)
+		labels = np.full(len(x), -1, dtype=np.intp)
+
+		if len(self.bounds) == 0:
+			return labels
+
+		b = self.bounds
+		inside = np.flatnonzero((x >= self.origin[0]) & (x <= b[:, 2].max()) &
+		                        (y >= self.origin[1]) & (y <= b[:, 3].max()))
+		(col, row) = self.cellOf(x[inside], y[inside])
+		cell = row * self.shape[0] + col
+		first = self.cellStart[cell]
+		count = self.cellStart[cell + 1] - first
+
+		# Test each point's first candidate, then its second, and so on,
+		# keeping only the points still without an area.
+		rank = 0
+		while len(inside) > 0:
+			more = count > rank
+			(inside, first, count) = (inside[more], first[more], count[more])
+			if len(inside) == 0:
+				break
+
+			a = self.cellAreas[first + rank]
+			hit = self.containsPoints(a, x[inside], y[inside])
+			labels[inside[hit]] = a[hit]
+
+			miss = ~hit
+			(inside, first, count) = (inside[miss], first[miss], count[miss])
+			rank += 1
+
+		return labels
+
+class TimedAreas(object):
+	"""Areas of interest that change over time, as on video stimuli or
+	   scrolling pages.
+
+	   'epochs' is a list of (startTime, areas) pairs.  Each list of areas
+	   applies from its start time until the next epoch starts, and
+	   before the first epoch no areas apply.  Every epoch gets its own
+	   AreaIndex, and the epoch of a sample is found by binary search on
+	   the start times.
+
+	   An area that appears in several epochs (an equal tuple, or the
+	   same Polygon) is the same area throughout: 'areas' lists each
+	   distinct area once, and lookups give positions in that list.
+	"""
+	def __init__(self, epochs):
+		epochs = sorted(epochs, key=lambda e: e[0])
+		self.startTimes = [e[0] for e in epochs]
+		self.starts = np.array(self.startTimes, dtype=float)
+		self.areas = []
+		self.indexes = []
+		self.ids = [] # Per epoch, positions in 'areas' of the epoch's areas
+
+		ids = {}
+		for (start, areas) in epochs:
+			areas = [tuple(a) if isinstance(a, list) else a for a in areas]
+			for a in areas:
+				if a not in ids:
+					ids[a] = len(self.areas)
+					self.areas.append(a)
+			self.indexes.append(AreaIndex(areas))
+			self.ids.append([ids[a] for a in areas])
+
+	def lookup(self, x, y, t):
+		""" The position in 'areas' of the area (x, y) is in at time t, or
+		    None. """
+		e = bisect.bisect_right(self.startTimes, t) - 1
+		if e < 0:
+			return None
+
+		a = self.indexes[e].lookup(x, y)
+		if a is None:
+			return None
+
+		return self.ids[e][a]
+
+	def labels(self, x, y, t):
+		""" Label arrays of points at times t with positions in 'areas',
+		    or -1. """
+		x = np.asarray(x, dtype=float)
+		y = np.asarray(y, dtype=float)
+		labels = np.full(len(x), -1, dtype=np.intp)
+
+		epoch = np.searchsorted(self.starts, np.asarray(t, dtype=float), 'right') - 1
+
+		# Group the points by epoch; for time-ordered samples the groups
+		# are already contiguous.
+		order = np.argsort(epoch, kind='mergesort')
+		bounds = np.searchsorted(epoch[order], np.arange(len(self.indexes) + 1), 'left')
+
+		for e in range(len(self.indexes)):
+			points = order[bounds[e]:bounds[e + 1]]
+			if len(points) == 0:
+				continue
+
+			found = self.indexes[e].labels(x[points], y[points])
+			ids = np.array(self.ids[e] + [-1], dtype=np.intp)
+			labels[points] = ids[found]
+
+		return labels
 
 class AOI(EventStream):
 	"""Areas of Interest event detection. 
 	   
 	   This is based on I-AOI of Salvucci and Goldberg (2000).
 
+	   Areas are looked up through an AreaIndex, so the cost per sample
+	   stays small with hundreds of areas.  In block mode, every sample
+	   in a block is labelled with its area at once.
+
 	   Parameters:
 		threshold: (samples) the duration above which to consider a fixation.
-		areas: A list of coordinate tuples denoting areas of interest.
-		   Currently always rectangular, with the form:
+		areas: A list of areas of interest.  Rectangular areas are
+		   coordinate tuples, with the form:
 		   (upperLeftX,upperLeftY,lowerRightX,lowerRightY)
+		   and other shapes are Polygons.  For areas that change over
+		   the recording, pass TimedAreas instead of a list.
 	"""
 	def __init__(self, sampleStream, threshold, areas):
 		super(AOI, self).__init__(sampleStream)
 		self.threshold = threshold
-		self.areas = areas
 
+		if isinstance(areas, TimedAreas):
+			self.areas = areas.areas
+			self.index = areas
+		else:
+			self.areas = areas
+			self.index = AreaIndex(areas)
 
 	def inArea(self, p):
-		for a in self.areas:
-			if p.x >= a[0] and p.x <= a[2] and p.y >= a[1] and p.y <= a[3]:
-				return a
+		a = self.index.lookup(p.x, p.y, p.time)
+		if a is None:
+			return None
 
-		return None
+		return self.areas[a]
 
 	def next(self):
 
@@ -63,20 +358,20 @@ class AOI(EventStream):
 					samples.append(s)
 				else:
 					end = samples.pop()
-					p = self.centroid(samples)
 					length = len(samples)
 
-					if length < self.threshold:
+					if length < self.threshold or length == 0:
 						samples = []
 						currentArea = None
 						continue
 					else:
+						p = self.centroid(samples)
 						return EFixation(p, length, samples[0], end)
 					
 			else:
 				# Outside an area of interest
 				currentArea = None
-				if len(samples) > self.threshold:
+				if len(samples) > self.threshold and len(samples) > 1:
 					end = samples.pop()
 					p = self.centroid(samples)
 					return EFixation(p, len(samples), samples[0], end)
@@ -87,4 +382,59 @@ class AOI(EventStream):
 
 		raise StopIteration
 
+	def labels(self, block):
+		""" The index into 'areas' of the area each sample in a block is
+		    in, or -1. """
+		return self.index.labels(block.x, block.y, block.time)
+
+	def processBlock(self, block):
+		""" Find the same fixations as next() over a whole block.
+
+		    Samples are grouped into stretches with the same area.  A
+		    stretch that directly follows a stretch already being
+		    collected loses its first sample, which is the one next()
+		    reads to see that the area has changed. """
+		labels = self.labels(block)
+
+		edges = np.flatnonzero(np.diff(labels)) + 1
+		starts = np.concatenate(([0], edges))[:len(labels)]
+		ends = np.concatenate((edges, [len(labels)])) - 1
+		areas = labels[starts]
+
+		fs = []
+		fe = []
+		collecting = False # Whether the previous stretch was being collected
+		for k in range(len(starts)):
+			if areas[k] < 0:
+				collecting = False
+				continue
+
+			s = starts[k]
+			e = ends[k]
+			if collecting:
+				s += 1
+			collecting = s <= e
+			if not collecting or k + 1 == len(starts):
+				# Dropped entirely, or cut off by the end of input.
+				continue
+
+			# The last sample is the fixation's end, not part of it.
+			length = e - s
+			if length == 0:
+				continue
+			if areas[k + 1] >= 0:
+				keep = length >= self.threshold
+			else:
+				keep = length + 1 > self.threshold
+
+			if keep:
+				fs.append(s)
+				fe.append(e)
+
+		starts = np.array(fs, dtype=np.intp)
+		ends = np.array(fe, dtype=np.intp)
+		lengths = ends - starts
+
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
 
+		return EventTable.fromBlock(block, EventTable.FIXATION, starts, ends, lengths, xc, yc)
@@ -36,11 +36,14 @@ class BlinkFilter(EventStream):
 	def next(self):
 		s = self.input.next()
 
-		if s.x == 0 and s.y == 0:
-			return self.next()
+		while s.x == 0 and s.y == 0:
+			s = self.input.next()
 
 		return s
 
+	def processBlock(self, block):
+		return block.select((block.x != 0) | (block.y != 0))
+
 		
 
 
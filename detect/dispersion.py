@@ -23,6 +23,35 @@
 from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
+from eventstream import EventTable
+
+import numpy as np
+
+def slidingExtreme(a, w, op):
+	"""Apply op (np.maximum or np.minimum) over each window a[i:i+w].
+
+	   Windows running off the end of the array are truncated, as the
+	   detector's window is at the end of its input.  This uses the van
+	   Herk/Gil-Werman method: prefix and suffix extremes within blocks of
+	   w samples, so the cost is O(n) whatever the window size."""
+	n = len(a)
+
+	if n == 0:
+		return a.copy()
+
+	m = (n + 2 * w - 1) // w
+
+	# Padding with the last value leaves every truncated window's extreme
+	# unchanged, since that value is in every such window.
+	padded = np.empty(m * w, dtype=a.dtype)
+	padded[:n] = a
+	padded[n:] = a[-1]
+
+	blocks = padded.reshape(m, w)
+	prefix = op.accumulate(blocks, axis=1).ravel()
+	suffix = op.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+	return op(suffix[:n], prefix[w - 1:w - 1 + n])
 
 class Dispersion(EventStream):
 	"""Simple dispersion-based algorithm. 
@@ -63,6 +92,11 @@ class Dispersion(EventStream):
 
 
 	def next(self):
+		return self.consumeUntilEvent(self.step)
+
+	def step(self):
+		""" Advance by one window position, returning a fixation if one
+		    ends here, or None if the window only slid on. """
 		# Fill the window with samples.
 		self.fillWindow()
 
@@ -96,10 +130,92 @@ class Dispersion(EventStream):
 			return EFixation(p, length, start, end)
 
 		else:
-			# Remove the first element
-			self.window = self.window[1:]
-			# Recurse.
-			return self.next()
+			# Remove the first element and try again from the next one.
+			del self.window[0]
+			return None
+
+	def growFixation(self, x, y, start, end):
+		""" Find the first position at or after 'end' at which the samples
+		    from 'start' stop fitting within the threshold, or len(x) if they
+		    all fit.  Scans forward in chunks of doubling size. """
+		n = len(x)
+
+		minx = x[start:end].min()
+		maxx = x[start:end].max()
+		miny = y[start:end].min()
+		maxy = y[start:end].max()
+
+		chunk = 4 * self.windowSize
+
+		while end < n:
+			cx = x[end:end + chunk]
+			cy = y[end:end + chunk]
+
+			d = (np.maximum.accumulate(np.maximum(cx, maxx)) - np.minimum.accumulate(np.minimum(cx, minx)) +
+			     np.maximum.accumulate(np.maximum(cy, maxy)) - np.minimum.accumulate(np.minimum(cy, miny)))
+
+			over = np.flatnonzero(d > self.threshold)
+			if len(over) > 0:
+				return end + over[0]
+
+			minx = min(minx, cx.min())
+			maxx = max(maxx, cx.max())
+			miny = min(miny, cy.min())
+			maxy = max(maxy, cy.max())
+
+			end = end + len(cx)
+			chunk = chunk * 2
+
+		return n
+
+	def processBlock(self, block):
+		""" Batch I-DT over a whole block, giving the same fixations as next().
+
+		    The dispersion of the initial window at every position comes from
+		    sliding minima and maxima, so the positions where a fixation can
+		    start are found in one pass.  Each fixation is then grown with
+		    a vectorised forward scan. """
+		x = block.x
+		y = block.y
+		n = len(block)
+
+		starts = []
+		ends = []
+
+		if n > 0 and self.windowSize > 0:
+			w = self.windowSize
+			d = (slidingExtreme(x, w, np.maximum) - slidingExtreme(x, w, np.minimum) +
+			     slidingExtreme(y, w, np.maximum) - slidingExtreme(y, w, np.minimum))
+			candidates = np.flatnonzero(d <= self.threshold)
+
+			p = 0
+			while True:
+				k = np.searchsorted(candidates, p)
+				if k == len(candidates):
+					break
+
+				p = candidates[k]
+				e = self.growFixation(x, y, p, min(p + w, n))
+
+				if e == n:
+					# Input ran out while growing: as in next(), the last
+					# sample is taken as the end point.
+					if n - 1 > p:
+						starts.append(p)
+						ends.append(n - 1)
+					break
+
+				starts.append(p)
+				ends.append(e)
+				p = e + 1
+
+		starts = np.array(starts, dtype=np.intp)
+		ends = np.array(ends, dtype=np.intp)
+		lengths = ends - starts
+
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
+
+		return EventTable.fromBlock(block, EventTable.FIXATION, starts, ends, lengths, xc, yc)
 
 
 
@@ -24,11 +24,184 @@ from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
 from eventstream import ESaccade
+from eventstream import EventTable
+from eventstream import findRuns
 
+import collections
+import heapq
 import math
-import random
 import numpy as np
 
+class RunningMedian(object):
+	"""
+	   The median of the most recent values pushed, over a sliding window
+	   of 'size' values (or of every value, if size is None).
+
+	   The values are split between a max-heap of the lower half and a
+	   min-heap of the upper half, so a push or an expiry costs O(log n).
+	   Expired values are only removed from the heaps when they reach the
+	   top, or when dead entries come to outnumber the live ones.
+	"""
+	def __init__(self, size=None):
+		self.size = size
+		self.low = [] # (-value, seq), a max-heap of the lower half
+		self.high = [] # (value, seq), a min-heap of the upper half
+		self.lowSize = 0 # Live entries in each heap
+		self.highSize = 0
+		self.side = {} # seq -> heap of each live entry
+		self.first = 0 # Oldest live seq
+		self.count = 0 # Next seq
+
+	def __len__(self):
+		return self.count - self.first
+
+	def prune(self, heap):
+		while len(heap) > 0 and heap[0][1] not in self.side:
+			heapq.heappop(heap)
+
+	def compact(self):
+		if len(self.low) > 2 * self.lowSize + 16:
+			self.low = [e for e in self.low if e[1] in self.side]
+			heapq.heapify(self.low)
+		if len(self.high) > 2 * self.highSize + 16:
+			self.high = [e for e in self.high if e[1] in self.side]
+			heapq.heapify(self.high)
+
+	def push(self, v):
+		seq = self.count
+		self.count += 1
+
+		self.prune(self.low)
+		if self.lowSize == 0 or v <= -self.low[0][0]:
+			heapq.heappush(self.low, (-v, seq))
+			self.side[seq] = 0
+			self.lowSize += 1
+		else:
+			heapq.heappush(self.high, (v, seq))
+			self.side[seq] = 1
+			self.highSize += 1
+
+		if self.size is not None and len(self) > self.size:
+			if self.side.pop(self.first) == 0:
+				self.lowSize -= 1
+			else:
+				self.highSize -= 1
+			self.first += 1
+			self.compact()
+
+		# Rebalance, so that the lower half has the extra entry if any.
+		while self.lowSize > self.highSize + 1:
+			self.prune(self.low)
+			(nv, s) = heapq.heappop(self.low)
+			heapq.heappush(self.high, (-nv, s))
+			self.side[s] = 1
+			self.lowSize -= 1
+			self.highSize += 1
+
+		while self.highSize > self.lowSize:
+			self.prune(self.high)
+			(v, s) = heapq.heappop(self.high)
+			heapq.heappush(self.low, (-v, s))
+			self.side[s] = 0
+			self.highSize -= 1
+			self.lowSize += 1
+
+	def median(self):
+		if len(self) == 0:
+			return None
+
+		self.prune(self.low)
+		if self.lowSize > self.highSize:
+			return -self.low[0][0]
+
+		self.prune(self.high)
+		return (-self.low[0][0] + self.high[0][0]) / 2.0
+
+def medianSigma(v):
+	"""
+	   The median-based estimate of the standard deviation of velocity
+	   used by Engbert and Kliegl, sqrt(median(v^2) - median(v)^2),
+	   computed over a whole recording.  'v' may be an array of
+	   velocities, or have one column per velocity component, in which
+	   case an array of estimates is returned.
+	"""
+	v = np.asarray(v, dtype=float)
+	m = np.median(np.array([v, v * v]), axis=1)
+
+	return np.sqrt(np.maximum(m[1] - m[0] * m[0], 0))
+
+def fivePointVelocity(block):
+	"""
+	   The velocity components (vx, vy) of Engbert and Kliegl's moving
+	   average, (x[n+2] + x[n+1] - x[n-1] - x[n-2]) / 6dt, for a whole
+	   block with one correlation per component.  dt is the mean sample
+	   interval across the five samples.
+
+	   Velocities are given for positions 2 to len(block) - 2: the last
+	   sample is repeated to fill the final window, as EngbertKliegl.next()
+	   does.
+	"""
+	if len(block) <= 3:
+		return (np.zeros(0), np.zeros(0))
+
+	kernel = np.array([-1.0, -1.0, 0.0, 1.0, 1.0])
+	t = np.append(block.time, block.time[-1]).astype(float)
+	dt = t[4:] - t[:-4]
+	dt[dt <= 0] = 1
+	dt = 6 * (dt / 4.0)
+
+	v = []
+	for c in (block.x, block.y):
+		c = np.append(c, c[-1]).astype(float)
+		v.append(np.correlate(c, kernel, 'valid') / dt)
+
+	return tuple(v)
+
+def ellipticTest(vx, vy, sx, sy, threshold):
+	"""
+	   Mark the velocities outside the ellipse with radii threshold * sigma.
+	   A component with no noise at all counts as over the threshold as
+	   soon as it moves.
+	"""
+	r = np.zeros(len(vx))
+	moving = np.zeros(len(vx), dtype=bool)
+
+	for (v, s) in ((vx, sx), (vy, sy)):
+		if s > 0:
+			r += (v / (threshold * s)) ** 2
+		else:
+			moving |= v != 0
+
+	return moving | (r > 1)
+
+def coincidentRuns(left, right):
+	"""
+	   The binocular criterion of Engbert and Kliegl (2003): keep only the
+	   runs (starts, ends) in one eye that overlap in time with a run in
+	   the other.  Each kept run is extended to cover the runs it overlaps,
+	   and runs that then overlap or touch are merged.
+	"""
+	(ls, le) = left
+	(rs, re) = right
+
+	# The first right run ending at or after each left run starts, and
+	# the last right run starting at or before it ends.
+	first = np.searchsorted(re, ls, 'left')
+	last = np.searchsorted(rs, le, 'right') - 1
+	both = first <= last
+
+	starts = np.minimum(ls[both], rs[first[both]])
+	ends = np.maximum(le[both], re[last[both]])
+
+	if len(starts) == 0:
+		return (starts, ends)
+
+	# Merge runs that overlap or touch after being extended.
+	group = np.concatenate(([True], starts[1:] > np.maximum.accumulate(ends)[:-1] + 1))
+	heads = np.flatnonzero(group)
+
+	return (starts[heads], np.maximum.reduceat(ends, heads))
+
 class EngbertKliegl(EventStream):
 	"""
 	   The velocity-based detector of Engbert and Kliegl (2003).
@@ -39,27 +212,45 @@ class EngbertKliegl(EventStream):
 	   the values for which will need to be calibrated for a given
 	   application and data collection setup.
 
-	   This version of the algorithm does not include the extensions for the use of
-	   binocular data --- this would be a possible adaptation, but the current version
-	   does not support it because it would render this implementation useless for
-	   monocular data without more careful consideration.
+	   Saccades are runs of at least minDuration saccadic samples.  Shorter
+	   runs are counted as part of the surrounding fixation.
+
+	   For binocular data, processBinocular() applies the paper's
+	   extension for microsaccades: only saccades that overlap in time in
+	   both eyes are kept.
+
+	   The noise level of each velocity component is estimated as
+	   sigma = sqrt(median(v^2) - median(v)^2), using running medians over
+	   the last medianWindow samples.  A sample is saccadic when its
+	   velocity lies outside the ellipse with radii threshold * sigma.
+	   The paper's estimate over a whole recording can be computed with
+	   medianSigma() and passed in as 'sigma' instead.  The block mode
+	   always estimates over the whole block, unless 'sigma' is given, in
+	   which case it finds the same events as next().
 
 	   Parameters:
 	     threshold (float) the detection threshold is computed as threshold (lambda) * the median noise level.
+	     (optional) minDuration (samples) the shortest run of saccadic samples taken as a saccade.
+	     (optional) medianWindow (samples) the number of samples the noise level is estimated over.
+	     (optional) sigma (x, y) a fixed noise level to use instead of the running estimate.
+	     (optional) debug a function called for every sample with the sample,
+	        its velocity components and the noise levels, as debug(sample, vx, vy, sigmaX, sigmaY).
 
 	"""
-	def __init__(self, sampleStream, threshold):
+	def __init__(self, sampleStream, threshold, minDuration=4, medianWindow=1000, sigma=None, debug=None):
 		super(EngbertKliegl, self).__init__(sampleStream)
 		self.threshold = threshold
+		self.minDuration = minDuration
 		self.windowSize = 5
-		self.window = []
-		self.xRes = [] # x-coordinate reservoir
-		self.yRes = [] # y-coordinate reservoir
-		self.resSize = 50
-		self.buf = [] # Buffer for events
-		self.inFix = False
-		self.inSacc = False
-		random.seed()
+		self.window = collections.deque()
+		self.sigma = sigma
+		self.debug = debug
+		# Running medians of vx, vx^2, vy and vy^2.
+		self.medians = [RunningMedian(medianWindow) for i in range(4)]
+		self.fix = [] # Samples of the current fixation
+		self.run = [] # Saccadic samples not yet long enough to be a saccade
+		self.events = collections.deque() # Events ready to return
+		self.finished = False
 
 	def fillWindow(self):
 		try:
@@ -69,111 +260,171 @@ class EngbertKliegl(EventStream):
 			return
 
 	def windowVelocity(self):
-		""" Compute average inter-sample velocity over a window of samples. """
-		
-		# Pad the window if it is under-size
-		
-		w = self.window[:]
-
-		while len(w) < self.windowSize:
-			w.append(self.window[-1])
-
-
-		xsum = 0
-		ysum = 0
+		""" Compute the velocity of the middle sample of the window, setting
+		    its 'vx' and 'vy'.  The last sample is repeated if the window
+		    is under-size. """
+		w = self.window
+		last = len(w) - 1
+		(w0, w1, w2, w3, w4) = [w[min(k, last)] for k in range(self.windowSize)]
 
-		dt = 0
-
-		xsum = w[4].x + w[3].x - w[1].x - w[0].x
-		ysum = w[4].y + w[3].y - w[1].y - w[0].y
-		dt = w[4].time - w[0].time
+		xsum = w4.x + w3.x - w1.x - w0.x
+		ysum = w4.y + w3.y - w1.y - w0.y
+		dt = w4.time - w0.time
 
 		if dt <= 0:
 			dt = 1
 
-		w[2].vx = xsum / float(6 * dt)    # average volocity over 6 samples
-		w[2].vy = ysum / float(6 * dt)
-
-		return w[2]
-
-	# Estimate a median by a reservoir-sampling method  ???????? isnt' that the mean?
-	def median(self, res):
-		# return sum(res) / len(res)
-		return np.median(res)
-
-	def medianEstimatorX(self,v):
-		if len(self.xRes) < self.resSize:
-			self.xRes.append(v*v)
-		#else:
-		#	p = random.randint(0,len(self.xRes)-1)
-		#	self.xRes[p] = v*v
-
-		return self.median(self.xRes)
-	
-	def medianEstimatorY(self,v):
-		if len(self.yRes) < self.resSize:
-			self.yRes.append(v*v)
-		#else:
-		#	p = random.randint(0,len(self.yRes)-1)
-		#	self.yRes[p] = v*v
-
-		return self.median(self.yRes)
+		# Average velocity over the window, with dt the sample interval.
+		w2.vx = xsum / (6 * (dt / 4.0))
+		w2.vy = ysum / (6 * (dt / 4.0))
+
+		return w2
+
+	def noiseLevel(self, vx, vy):
+		""" Update the running noise estimates with a velocity, returning
+		    (sigmaX, sigmaY). """
+		if self.sigma is not None:
+			return self.sigma
+
+		sigma = []
+		for (v, mv, mv2) in ((vx, self.medians[0], self.medians[1]), (vy, self.medians[2], self.medians[3])):
+			mv.push(v)
+			mv2.push(v * v)
+			m = mv.median()
+			sigma.append(math.sqrt(max(mv2.median() - m * m, 0)))
+
+		return sigma
+
+	def isSaccadic(self, vx, vy, sx, sy):
+		""" Test whether a velocity is outside the threshold ellipse, as
+		    ellipticTest() does for arrays. """
+		r = 0.0
+		for (v, s) in ((vx, sx), (vy, sy)):
+			if s > 0:
+				r = r + (v / (self.threshold * s)) ** 2
+			elif v != 0:
+				return True
+
+		return r > 1
+
+	def endRun(self):
+		""" Close the current run of saccadic samples: a saccade if it is
+		    long enough, otherwise part of the fixation. """
+		if len(self.run) >= self.minDuration:
+			if len(self.fix) > 0:
+				c = self.centroid(self.fix)
+				self.events.append(EFixation(c, len(self.fix), self.fix[0], self.fix[-1]))
+			self.events.append(ESaccade(len(self.run), self.run[0], self.run[-1]))
+			self.fix = []
+		else:
+			self.fix.extend(self.run)
+		self.run = []
 
 	def next(self):
-		self.fillWindow()
-
-		if len(self.window) <= 3:
-			raise StopIteration
+		while len(self.events) == 0:
+			if self.finished:
+				raise StopIteration
 
-		v = self.windowVelocity()
+			self.fillWindow()
 
-		# print "Velocity: " + str(v.vx) + " / " + str(v.vy)
+			if len(self.window) <= 3:
+				# End of input: close whatever is open.
+				self.finished = True
+				self.endRun()
+				if len(self.fix) > 0:
+					c = self.centroid(self.fix)
+					self.events.append(EFixation(c, len(self.fix), self.fix[0], self.fix[-1]))
+					self.fix = []
+				continue
 
-		mx = self.medianEstimatorX(v.vx)
-		my = self.medianEstimatorY(v.vy)
-		
-		# print "Median: " + str(mx) + " / " + str(my)
+			v = self.windowVelocity()
 
-		# sdx = (v.vx * v.vx) - (mx * mx)
-		sdx = (v.vx * v.vx) - mx
-		# sdy = (v.vy * v.vy) - (my * my)
-		sdy = (v.vy * v.vy) - my
+			(sx, sy) = self.noiseLevel(v.vx, v.vy)
 
-		# print "Std.Dev: " + str(sdx * self.threshold) + " / " + str(sdy * self.threshold)
+			if self.debug is not None:
+				self.debug(v, v.vx, v.vy, sx, sy)
 
-		samp = self.window[2]
+			if self.isSaccadic(v.vx, v.vy, sx, sy):
+				self.run.append(v)
+			else:
+				self.endRun()
+				self.fix.append(v)
 
-		r = None
+			self.window.popleft()
 
-		print "x"
-		print v.vx
-		print sdx
-		print "y"
-		print v.vy
-		print sdy
-		if v.vx >= sdx * self.threshold and v.vy >= sdy * self.threshold:
-			self.inSacc = True
+		return self.events.popleft()
 
-			if self.inFix and len(self.buf) > 1:
-				self.inFix = False
-				c = self.centroid(self.window)
-				r = EFixation(c, len(self.buf), self.buf[0], self.buf[-1])
-				self.buf = []
+	def saccadeRuns(self, block):
+		""" Find the saccades in a block, as arrays of first and last
+		    positions. """
+		(vx, vy) = fivePointVelocity(block)
 
-			self.buf.append(samp)
+		if self.sigma is not None:
+			(sx, sy) = self.sigma
+		elif len(vx) > 0:
+			(sx, sy) = medianSigma(np.column_stack((vx, vy)))
 		else:
-			self.inFix = True
-
-			if self.inSacc:
-				self.inSacc = False
-				if len(self.buf) > 3:
-					r = ESaccade(len(self.buf), self.buf[0], self.buf[-1])
-				self.buf = []
-
-		self.window = self.window[1:]
-		
-		if r != None:
-			return r
-		else:
-			return self.next()
-
+			(sx, sy) = (0, 0)
+
+		(starts, lengths) = findRuns(ellipticTest(vx, vy, sx, sy, self.threshold))
+		keep = lengths >= self.minDuration
+
+		# Velocities start at the third sample.
+		starts = starts[keep] + 2
+		return (starts, starts + lengths[keep] - 1)
+
+	def eventTable(self, block, starts, ends):
+		""" Build the events for saccades at (starts, ends), with fixations
+		    filling the gaps between them. """
+		n = len(block)
+		if n <= 3:
+			return EventTable.fromBlock(block, [], [], [], [])
+
+		# Fixations run between saccades, over the samples that have velocities.
+		fs = np.concatenate(([2], ends + 1))
+		fe = np.concatenate((starts - 1, [n - 2]))
+		fix = fe >= fs
+
+		types = np.empty(len(starts) + len(fs), dtype=np.int8)
+		types[0::2] = EventTable.FIXATION
+		types[1::2] = EventTable.SACCADE
+		first = np.empty(len(types), dtype=np.intp)
+		first[0::2] = fs
+		first[1::2] = starts
+		last = np.empty(len(types), dtype=np.intp)
+		last[0::2] = fe
+		last[1::2] = ends
+
+		present = np.ones(len(types), dtype=bool)
+		present[0::2] = fix
+		(types, first, last) = (types[present], first[present], last[present])
+		lengths = last - first + 1
+
+		(xc, yc) = self.blockCentroids(block, first, lengths)
+		xc[types == EventTable.SACCADE] = np.nan
+		yc[types == EventTable.SACCADE] = np.nan
+
+		return EventTable.fromBlock(block, types, first, last, lengths, xc, yc)
+
+	def hasBlockMode(self):
+		"""The block mode estimates the noise level over the whole block,
+		   not with running medians, so it only matches next() when
+		   'sigma' is fixed."""
+		return self.sigma is not None
+
+	def processBlock(self, block):
+		""" Detect the fixations and saccades in a whole block at once. """
+		(starts, ends) = self.saccadeRuns(block)
+
+		return self.eventTable(block, starts, ends)
+
+	def processBinocular(self, left, right):
+		""" Detect events in simultaneous blocks for the left and right
+		    eyes, keeping only the saccades that overlap in time in both.
+		    Positions and fixation centroids are taken from the left eye. """
+		if len(left) != len(right):
+			raise ValueError("binocular blocks must have the same length")
+
+		(starts, ends) = coincidentRuns(self.saccadeRuns(left), self.saccadeRuns(right))
+
+		return self.eventTable(left, starts, ends)
@@ -0,0 +1,172 @@
+###############################################################################
+# Event Detection Algorithm Suite
+#  Copyright (C) 2012 Gian Perrone (http://github.com/gian)
+#  
+#  Permission to use, copy, modify, and distribute this software and its
+#  documentation for any purpose and without fee is hereby granted,
+#  provided that the above copyright notice appear in all copies and that
+#  both the copyright notice and this permission notice and warranty
+#  disclaimer appear in supporting documentation, and that the name of
+#  the above copyright holders, or their entities, not be used in
+#  advertising or publicity pertaining to distribution of the software
+#  without specific, written prior permission.
+#  
+#  The above copyright holders disclaim all warranties with regard to
+#  this software, including all implied warranties of merchantability and
+#  fitness. In no event shall the above copyright holders be liable for
+#  any special, indirect or consequential damages or any damages
+#  whatsoever resulting from loss of use, data or profits, whether in an
+#  action of contract, negligence or other tortious action, arising out
+#  of or in connection with the use or performance of this software.
+###############################################################################
+
+from . import eventstream
+from eventstream import EventTable
+
+import numpy as np
+
+# Per-sample labels: the EventTable codes, and NONE for samples in no
+# event (or, in ground truth, in events of another kind, such as blinks).
+NONE = 0
+FIXATION = EventTable.FIXATION
+SACCADE = EventTable.SACCADE
+CLASSES = (NONE, FIXATION, SACCADE)
+classNames = {NONE: 'none', FIXATION: 'fixation', SACCADE: 'saccade'}
+
+def eventLabels(events, index):
+	"""Label samples with the detector events covering them.
+
+	   'events' is an EventTable or a sequence of EFixation/ESaccade
+	   objects; 'index' holds the sample indices of the samples to label,
+	   in increasing order, usually the index column of the ground truth
+	   block.  As in the old scoring scripts, an event covers 'length'
+	   samples from its first one, so the ground truth should be filtered
+	   the way the detector's input was (e.g. with BlinkFilter).  Where
+	   events overlap, the one starting later wins."""
+	if not isinstance(events, EventTable):
+		events = EventTable.fromEvents(events)
+
+	index = np.asarray(index)
+	n = len(index)
+	labels = np.zeros(n, dtype=np.int8)
+
+	if len(events) == 0 or n == 0:
+		return labels
+
+	starts = np.searchsorted(index, events.startIndex)
+	order = np.argsort(starts, kind='mergesort')
+	starts = starts[order]
+	ends = starts + events.length[order]
+	types = events.type[order]
+
+	if np.any(starts[1:] < ends[:-1]):
+		# Overlapping events: paint them in order.
+		for (s, e, t) in zip(starts.tolist(), ends.tolist(), types.tolist()):
+			labels[s:e] = t
+		return labels
+
+	# Each event adds its type at its first sample and takes it away
+	# after its last.
+	ends = np.minimum(ends, n)
+	delta = (np.bincount(starts, weights=types, minlength=n + 1) -
+	         np.bincount(ends, weights=types, minlength=n + 1))
+	labels[:] = np.cumsum(delta[:n])
+
+	return labels
+
+def truthLabels(block, classes=CLASSES):
+	"""Ground-truth labels from a block's eventType column, with codes
+	   other than those in 'classes' counted as NONE."""
+	t = np.asarray(block.eventType)
+	return np.where(np.isin(t, classes), t, NONE).astype(np.int8)
+
+class Agreement(object):
+	"""A confusion matrix between ground-truth and detected labels, with
+	   the usual sample-level scores.
+
+	   matrix[i, j] counts the samples labelled classes[i] in the ground
+	   truth and classes[j] by the detector.  Agreements over the same
+	   classes can be added, to score a corpus one recording at a time.
+	"""
+	def __init__(self, classes, matrix):
+		self.classes = tuple(classes)
+		self.matrix = np.asarray(matrix, dtype=np.int64)
+
+	@classmethod
+	def fromLabels(cls, truth, predicted, classes=CLASSES):
+		truth = np.asarray(truth)
+		predicted = np.asarray(predicted)
+
+		if len(truth) != len(predicted):
+			raise ValueError("%d ground-truth labels but %d detected" % (len(truth), len(predicted)))
+
+		# Number the classes through a table indexed by label.
+		k = len(classes)
+		table = np.full(max(classes) + 1, -1, dtype=np.intp)
+		table[list(classes)] = np.arange(k)
+
+		codes = []
+		for labels in (truth, predicted):
+			if len(labels) > 0 and (labels.min() < 0 or labels.max() >= len(table)):
+				raise ValueError("Labels outside %s" % (classes,))
+			c = table[labels]
+			if np.any(c < 0):
+				raise ValueError("Labels outside %s" % (classes,))
+			codes.append(c)
+
+		matrix = np.bincount(codes[0] * k + codes[1], minlength=k * k).reshape(k, k)
+
+		return cls(classes, matrix)
+
+	def __add__(self, other):
+		if self.classes != other.classes:
+			raise ValueError("Agreements over different classes")
+		return Agreement(self.classes, self.matrix + other.matrix)
+
+	def total(self):
+		return int(self.matrix.sum())
+
+	def agreement(self):
+		""" The fraction of samples given the same label. """
+		return np.trace(self.matrix) / float(max(self.total(), 1))
+
+	def precision(self, c):
+		""" The fraction of samples detected as c that are c; NaN if
+		    there are none. """
+		i = self.classes.index(c)
+		detected = self.matrix[:, i].sum()
+		return self.matrix[i, i] / float(detected) if detected > 0 else np.nan
+
+	def recall(self, c):
+		""" The fraction of samples of class c detected as c; NaN if
+		    there are none. """
+		i = self.classes.index(c)
+		actual = self.matrix[i, :].sum()
+		return self.matrix[i, i] / float(actual) if actual > 0 else np.nan
+
+	def kappa(self):
+		""" Cohen's kappa: agreement corrected for what the label
+		    frequencies alone would give by chance. """
+		n = float(self.total())
+		if n == 0:
+			return np.nan
+
+		observed = np.trace(self.matrix) / n
+		chance = np.dot(self.matrix.sum(axis=1), self.matrix.sum(axis=0)) / (n * n)
+
+		if chance == 1:
+			return 1.0
+
+		return (observed - chance) / (1 - chance)
+
+	def __str__(self):
+		lines = ["Samples: %d, agreement: %.2f%%, kappa: %.3f" % (self.total(), self.agreement() * 100, self.kappa())]
+		for c in self.classes:
+			lines.append("  %-9s precision: %6.2f%%  recall: %6.2f%%" % (
+				classNames.get(c, str(c)), self.precision(c) * 100, self.recall(c) * 100))
+		return "\n".join(lines)
+
+def evaluate(events, truth, classes=CLASSES):
+	"""Score detector events against a ground-truth block, returning an
+	   Agreement."""
+	return Agreement.fromLabels(truthLabels(truth, classes), eventLabels(events, truth.index), classes)
@@ -20,6 +20,10 @@
 #  of or in connection with the use or performance of this software.
 ###############################################################################
 
+from . import sample
+
+import numpy as np
+
 class EventStream(object):
 	"""The base type for all event detection providers."""
 	def __init__(self,sampleStream):
@@ -34,6 +38,40 @@ class EventStream(object):
 		"""Event detectors should override the next method."""
 		raise StopIteration
 
+	def consumeUntilEvent(self, step):
+		"""Drive a detector's state machine: call step() until it returns
+		   something other than None, and return that.
+
+		   Detectors whose next() skips over samples (through a saccade, a
+		   noisy stretch or a blink) use this instead of calling next()
+		   again, which costs a stack frame per skipped sample and fails
+		   on long stretches.  step() raises StopIteration when the input
+		   runs out."""
+		while True:
+			event = step()
+			if event is not None:
+				return event
+
+	def nextBlock(self, size=None):
+		"""Collect the next 'size' samples (default: all remaining) emitted
+		   by a filter stage into a SampleBlock."""
+		return sample.readBlock(self, size)
+
+	def processBlock(self, block):
+		"""Process a whole SampleBlock in one pass.
+
+		   Filters return a new SampleBlock, detectors return their events
+		   as an EventTable.  The block is treated as the complete input, so
+		   the result matches what next() would produce when reading the
+		   same samples one at a time.  Stages with a vectorised
+		   implementation override this."""
+		raise NotImplementedError("%s has no block mode" % type(self).__name__)
+
+	def hasBlockMode(self):
+		"""True if processBlock gives the same output as next().  Stages
+		   whose block mode only matches for some settings override this."""
+		return type(self).processBlock != EventStream.processBlock
+
 	def centroid(self,window):
 		"""Compute a centroid for a window of points."""
 		xs = 0
@@ -55,30 +93,211 @@ class EventStream(object):
 
 		return pc
 
+	def blockCentroids(self, block, starts, lengths):
+		"""Compute centroids for runs of samples in a block, rounded the
+		   same way as centroid().  Returns arrays of x and y."""
+		starts = np.asarray(starts, dtype=np.intp)
+		ends = starts + np.asarray(lengths, dtype=np.intp)
+
+		xc = np.zeros(len(starts))
+		yc = np.zeros(len(starts))
+
+		for (c, v) in ((xc, block.x), (yc, block.y)):
+			if len(starts) == 0:
+				continue
+			cs = np.concatenate(([0], np.cumsum(v)))
+			c[:] = roundHalfAway((cs[ends] - cs[starts]) / np.maximum(ends - starts, 1).astype(float))
+
+		return (xc, yc)
+
+def roundHalfAway(a):
+	"""Round an array the way the built-in round() does (halves away
+	   from zero), rather than NumPy's round-half-to-even."""
+	return np.sign(a) * np.floor(np.abs(a) + 0.5)
+
+def findRuns(mask):
+	"""Find the runs of True in a boolean array.
+
+	   Returns (starts, lengths) as arrays of positions and run lengths."""
+	edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+	starts = np.flatnonzero(edges == 1)
+	ends = np.flatnonzero(edges == -1)
+
+	return (starts, ends - starts)
+
 class DetectorEvent(object):
-	def __init__(self):
-		self.type = "none"
+	"""Base type for detector output.
+
+	   Events are compact records: rather than holding on to the Sample
+	   objects they were built from, they keep the index, time and position
+	   of their first and last samples.  The 'start' and 'end' attributes
+	   rebuild Sample objects from those fields when asked for.
+	"""
+	__slots__ = ('length', 'startIndex', 'startTime', 'startX', 'startY',
+	             'endIndex', 'endTime', 'endX', 'endY')
+	type = "none"
+
+	def __init__(self, length=0, start=None, end=None):
+		self.length = length
+
+		if start is None:
+			self.startIndex = self.startTime = self.startX = self.startY = None
+		else:
+			self.startIndex = start.index
+			self.startTime = start.time
+			self.startX = start.x
+			self.startY = start.y
+
+		if end is None:
+			self.endIndex = self.endTime = self.endX = self.endY = None
+		else:
+			self.endIndex = end.index
+			self.endTime = end.time
+			self.endX = end.x
+			self.endY = end.y
+
+	@property
+	def start(self):
+		return sample.Sample(self.startIndex, self.startTime, self.startX, self.startY)
+
+	@property
+	def end(self):
+		return sample.Sample(self.endIndex, self.endTime, self.endX, self.endY)
 
 
 class EFixation(DetectorEvent):
+	__slots__ = ('x', 'y')
+	type = "fixation"
+
 	def __init__(self,center,length,start,end):
-		self.type = "fixation"
-		self.center = center
-		self.length = length
-		self.start = start
-		self.end = end
+		super(EFixation, self).__init__(length, start, end)
+		self.x = center.x
+		self.y = center.y
+
+	@property
+	def center(self):
+		return sample.Sample(self.startIndex, self.startTime, self.x, self.y)
 	
 	def __str__(self):
-		return "Fixation at (%d,%d) of %d samples, starting at sample %d" % (self.center.x,self.center.y,self.length,self.start.index) 
+		return "Fixation at (%d,%d) of %d samples, starting at sample %d" % (self.x,self.y,self.length,self.startIndex) 
 
 class ESaccade(DetectorEvent):
+	__slots__ = ()
+	type = "saccade"
+
 	def __init__(self,length,start,end):
-		self.type = "saccade"
-		self.length = length
-		self.start = start
-		self.end = end
+		super(ESaccade, self).__init__(length, start, end)
 	
 	def __str__(self):
-		return "Saccade of %d samples, (%d,%d) -> (%d,%d)" % (self.length,self.start.x,self.start.y,self.end.x,self.end.y) 
+		return "Saccade of %d samples, (%d,%d) -> (%d,%d)" % (self.length,self.startX,self.startY,self.endX,self.endY) 
+
+class EventTable(object):
+	"""Detector output held column-wise, one row per event.
+
+	   This is what detectors return from processBlock.  The 'type' column
+	   uses the codes of labelled recordings (FIXATION or SACCADE); the
+	   others mirror the fields of DetectorEvent, with 'x' and 'y' holding
+	   fixation centroids (NaN for saccades).  Iterating over a table gives
+	   EFixation and ESaccade objects, so it can stand in for the list of
+	   events a detector's next() would have produced.
+	"""
+	FIXATION = 1
+	SACCADE = 2
+
+	fields = ('type', 'length', 'startIndex', 'startTime', 'startX', 'startY',
+	          'endIndex', 'endTime', 'endX', 'endY', 'x', 'y')
+
+	def __init__(self, **columns):
+		self.columns = {}
+		for name in EventTable.fields:
+			self.columns[name] = np.asarray(columns[name])
+
+	@classmethod
+	def fromBlock(cls, block, types, starts, ends, lengths, x=None, y=None):
+		"""Build a table from positions in a block.
+
+		   'starts' and 'ends' give the positions of the first and last
+		   samples recorded for each event, 'x' and 'y' the fixation
+		   centroids."""
+		starts = np.asarray(starts, dtype=np.intp)
+		ends = np.asarray(ends, dtype=np.intp)
+		n = len(starts)
+
+		columns = {
+			'type': np.broadcast_to(np.asarray(types, dtype=np.int8), (n,)).copy(),
+			'length': np.asarray(lengths, dtype=np.int64),
+			'x': np.full(n, np.nan) if x is None else np.asarray(x, dtype=float),
+			'y': np.full(n, np.nan) if y is None else np.asarray(y, dtype=float),
+		}
+
+		for (prefix, pos) in (('start', starts), ('end', ends)):
+			columns[prefix + 'Index'] = block.index[pos]
+			columns[prefix + 'Time'] = block.time[pos]
+			columns[prefix + 'X'] = block.x[pos]
+			columns[prefix + 'Y'] = block.y[pos]
+
+		# The streaming detectors take the centroid() of a fixation before
+		# recording it, which moves its first sample onto the centroid.
+		if x is not None:
+			fix = columns['type'] == EventTable.FIXATION
+			for (prefix, pos) in (('start', fix), ('end', fix & (ends == starts))):
+				columns[prefix + 'X'] = np.where(pos, columns['x'], columns[prefix + 'X'])
+				columns[prefix + 'Y'] = np.where(pos, columns['y'], columns[prefix + 'Y'])
+
+		return cls(**columns)
+
+	@classmethod
+	def fromEvents(cls, events):
+		"""Build a table from EFixation and ESaccade objects."""
+		events = list(events)
+		columns = {}
+
+		for name in EventTable.fields:
+			columns[name] = []
+
+		for e in events:
+			for name in DetectorEvent.__slots__:
+				columns[name].append(getattr(e, name))
+
+			if e.type == 'fixation':
+				columns['type'].append(EventTable.FIXATION)
+				columns['x'].append(e.x)
+				columns['y'].append(e.y)
+			else:
+				columns['type'].append(EventTable.SACCADE)
+				columns['x'].append(np.nan)
+				columns['y'].append(np.nan)
+
+		return cls(**columns)
+
+	def __len__(self):
+		return len(self.columns['type'])
+
+	def __getattr__(self, name):
+		try:
+			return self.__dict__['columns'][name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __iter__(self):
+		Sample = sample.Sample
+		rows = zip(*[self.columns[name].tolist() for name in EventTable.fields])
+
+		for (t, length, si, st, sx, sy, ei, et, ex, ey, x, y) in rows:
+			start = Sample(si, st, sx, sy)
+			end = Sample(ei, et, ex, ey)
+
+			if t == EventTable.FIXATION:
+				yield EFixation(Sample(si, st, x, y), length, start, end)
+			else:
+				yield ESaccade(length, start, end)
+
+	def __str__(self):
+		return "EventTable of %d events" % len(self)
 
+	def __repr__(self):
+		return self.__str__()
 
+	def events(self):
+		"""The table as a list of EFixation and ESaccade objects."""
+		return list(self)
@@ -24,8 +24,16 @@ from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
 from eventstream import ESaccade
+from eventstream import EventTable
+from . import sample
+from sample import readBlock
+from . import intersamplevelocity
+from intersamplevelocity import intersampleVelocities
 
+import array
+import collections
 import math
+import numpy as np
 
 class HMM(EventStream):
 	"""Hidden Markov Model-based detector.
@@ -35,6 +43,18 @@ class HMM(EventStream):
 	   This is primarily an offline algorithm, in that it needs all input
 	   available, and then it caches output.
 
+	   Decoding keeps only the forward scores of the two states and an
+	   int8 array of backpointers, so it runs in linear time and memory.
+
+	   Given a 'lag' (in samples), it runs online instead, as a fixed-lag
+	   decoder.  A sample's state is committed as soon as the surviving
+	   paths of both states agree on it.  If they have not agreed after
+	   'lag' samples, the older half of the pending samples is committed
+	   along the currently best path.  Events are emitted as soon as their
+	   last sample is committed, and memory use is bounded by the lag.
+	   If the paths always converge within the lag, the output is the same
+	   as offline decoding.
+
 	   Parameters:
 	   	* Fixation Observation Probability mean
 	   	* Fixation Observation Probability variance
@@ -44,10 +64,14 @@ class HMM(EventStream):
 		* P(fix -> sacc)
 		* P(sacc -> sacc)
 		* P(sacc -> fix)
+		* (optional) lag: decode online, with at most this many samples of delay.
 	"""
-	def __init__(self, sampleStream, fOPm, fOPv, sOPm, sOPv, Pff, Pfs, Pss, Psf):
+	FIX = 0
+	SAC = 1
+	stateNames = ('fix', 'sac')
+
+	def __init__(self, sampleStream, fOPm, fOPv, sOPm, sOPv, Pff, Pfs, Pss, Psf, lag=None):
 		super(HMM, self).__init__(sampleStream)
-		self.prev = self.input.next()
 		self.fOPm = fOPm
 		self.fOPv = fOPv
 		self.sOPm = sOPm
@@ -56,146 +80,476 @@ class HMM(EventStream):
 		self.Pfs = math.log(Pfs)
 		self.Pss = math.log(Pss)
 		self.Psf = math.log(Psf)
-		self.output = []
-		self.exhausted = False
+		self.startP = np.log([0.55, 0.45])
+		self.output = None
+
+		# State for online decoding.
+		self.lag = lag
+		self.prev = None
+		self.scores = None
+		self.pending = collections.deque() # (sample, fix pointer, sac pointer)
+		self.events = collections.deque()
+		self.finished = False
+		self.evState = None
+		self.evStart = None
+		self.evEnd = None
+		self.evLength = 0
+		self.evX = 0
+		self.evY = 0
+
+	def observations(self, block):
+		"""Intersample velocities between each sample and the next."""
+		return intersampleVelocities(block)
+
+	def emissionLogP(self, obs):
+		"""Log probability of each observation in each state, as an
+		   (observations x states) array."""
+		obs = np.asarray(obs, dtype=float)
+		e = np.empty((len(obs), 2))
+
+		params = ((self.fOPm, self.fOPv), (self.sOPm, self.sOPv))
+
+		for (k, (mu, sigma)) in enumerate(params):
+			p = np.exp(-np.square(obs - mu) / (2.0 * sigma * sigma)) / (sigma * math.sqrt(2.0 * math.pi))
+			p[p == 0] = 0.0001
+			e[:,k] = np.log(p)
+
+		return e
+
+	def sampleEmissionLogP(self, v):
+		"""emissionLogP for a single observation, as a (fix, sac) pair."""
+		r = []
+
+		for (mu, sigma) in ((self.fOPm, self.fOPv), (self.sOPm, self.sOPv)):
+			p = math.exp(-math.pow(v - mu, 2) / (2.0 * sigma * sigma)) / (sigma * math.sqrt(2.0 * math.pi))
+			if p == 0:
+				p = 0.0001
+			r.append(math.log(p))
+
+		return r
+
+	def transitionLogP(self):
+		"""Log transition probabilities, indexed [from state, to state]."""
+		return np.array([[self.Pff, self.Pfs], [self.Psf, self.Pss]])
+
+	def decode(self, obs):
+		"""Run the Viterbi algorithm over a sequence of observations (read:
+		   velocities).
+
+		   Returns (log probability, states), where states is an int8 array
+		   of FIX and SAC codes.  Ties go to the saccade state."""
+		n = len(obs)
+
+		if n == 0:
+			return (0.0, np.zeros(0, dtype=np.int8))
+
+		e = self.emissionLogP(obs)
+		T = self.transitionLogP()
+		((ff, fs), (sf, ss)) = T.tolist()
+
+		ef = e[:,0].tolist()
+		es = e[:,1].tolist()
+
+		# Forward pass.  With only two states, plain floats beat any
+		# per-step array operation.
+		vf = array.array('d', [0.0]) * n
+		vs = array.array('d', [0.0]) * n
+
+		f = self.startP[0] + ef[0]
+		s = self.startP[1] + es[0]
+		vf[0] = f
+		vs[0] = s
+
+		for t in xrange(1, n):
+			a = f + ff
+			b = s + sf
+			nf = (b if b >= a else a) + ef[t]
+			a = f + fs
+			b = s + ss
+			s = (b if b >= a else a) + es[t]
+			f = nf
+			vf[t] = f
+			vs[t] = s
+
+		# Backpointers for all steps at once: back[t-1,y] is the best
+		# predecessor of state y at step t.
+		V = np.column_stack((np.frombuffer(vf), np.frombuffer(vs)))
+		back = (V[:-1,1,None] + T[1] >= V[:-1,0,None] + T[0]).astype(np.int8)
+
+		b0 = bytearray(back[:,0].tobytes())
+		b1 = bytearray(back[:,1].tobytes())
+
+		state = HMM.SAC if s >= f else HMM.FIX
+		prob = max(f, s)
 
-	def normal(self,mu,sigma,x):
-		"""Return P(x) for a normal distribution with given mu and sigma"""
-		return (1.0 / (sigma * math.sqrt(2.0 * math.pi))) * math.exp(-math.pow(x - mu,2) / (2 * sigma * sigma))
+		states = bytearray(n)
+		states[n - 1] = state
+
+		for t in xrange(n - 1, 0, -1):
+			state = (b1 if state else b0)[t - 1]
+			states[t - 1] = state
+
+		return (prob, np.frombuffer(states, dtype=np.int8))
+
+	def viterbi(self, obs):
+		"""As decode(), but with the path given as a list of state names."""
+		(prob, states) = self.decode(obs)
+		return (prob, [HMM.stateNames[k] for k in states.tolist()])
+
+	def eventTable(self, block, states):
+		"""Turn a decoded state sequence over the leading samples of a
+		   block into fixations and saccades.  Each fixation's first
+		   sample is placed at its centroid, as centroid() leaves it."""
+		n = len(states)
+
+		if n == 0:
+			return EventTable.fromBlock(block, EventTable.FIXATION, [], [], [])
+
+		starts = np.concatenate(([0], np.flatnonzero(np.diff(states)) + 1))
+		lengths = np.diff(np.concatenate((starts, [n])))
+		ends = starts + lengths - 1
+
+		types = np.where(states[starts] == HMM.FIX, EventTable.FIXATION, EventTable.SACCADE)
+
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
+		xc[types == EventTable.SACCADE] = np.nan
+		yc[types == EventTable.SACCADE] = np.nan
+
+		return EventTable.fromBlock(block, types, starts, ends, lengths, xc, yc)
+
+	def hasBlockMode(self):
+		"""processBlock always decodes offline, so it only stands in for
+		   next() when there is no lag."""
+		return self.lag is None
+
+	def processBlock(self, block):
+		# Each observation is the velocity from a sample to the next,
+		# so the last sample only contributes to the final observation.
+		(prob, states) = self.decode(self.observations(block))
+
+		return self.eventTable(block, states)
+
+	def observe(self, curr):
+		""" Online decoding: advance the forward pass by one sample. """
+		prev = self.prev
+		self.prev = curr
+
+		if prev is None:
+			return
 
-	def intersampleVelocity(self,prev,curr):
 		dx = curr.x - prev.x
 		dy = curr.y - prev.y
 		dt = curr.time - prev.time
 
-		if dt <= 0:
-			# We can't work with a zero or negative time interval, so we
-			# Return a large junk value here in the hope it will be filtered.
-			return 0.0
+		v = 0.0
+		if dt > 0:
+			v = math.sqrt(dx * dx + dy * dy) / float(dt)
 
-		d = math.sqrt(dx * dx + dy * dy)
+		(ef, es) = self.sampleEmissionLogP(v)
 
-		return d / float(dt)
-	
-	# The probability of observing o in state s (fix=0,sac=1)
-	def emitP(self,s,o):
-		if s == 'fix':
-			p = self.normal(self.fOPm,self.fOPv,o)
-			if p == 0:
-				p = 0.0001
-			return math.log(p)
+		if self.scores is None:
+			self.scores = (self.startP[0] + ef, self.startP[1] + es)
+			self.pending.append((prev, 0, 0))
+			return
+
+		(f, s) = self.scores
+
+		a = f + self.Pff
+		b = s + self.Psf
+		bf = HMM.SAC if b >= a else HMM.FIX
+		nf = max(a, b) + ef
+
+		a = f + self.Pfs
+		b = s + self.Pss
+		bs = HMM.SAC if b >= a else HMM.FIX
+		ns = max(a, b) + es
+
+		self.scores = (nf, ns)
+		self.pending.append((prev, bf, bs))
+
+		if bf == bs:
+			# Both survivors pass through the same state at the previous
+			# sample, so everything up to there is settled.
+			self.commit(len(self.pending) - 2, bf)
+		elif len(self.pending) > self.lag:
+			(f, s) = self.scores
+			best = HMM.SAC if s >= f else HMM.FIX
+			self.commit(len(self.pending) - 1, best, len(self.pending) - 1 - self.lag // 2)
+
+	def commit(self, last, state, upto=None):
+		""" Trace back from pending sample 'last' in 'state', and commit
+		    the states of the pending samples up to 'upto' (default: 'last'). """
+		if upto is None:
+			upto = last
+
+		if last < 0:
+			# The previous sample was already committed by force.
+			return
+
+		states = bytearray(last + 1)
+		states[last] = state
+
+		for j in xrange(last, 0, -1):
+			state = self.pending[j][1 + state]
+			states[j - 1] = state
+
+		for j in xrange(0, upto + 1):
+			self.emitState(self.pending.popleft()[0], states[j])
+
+	def emitState(self, s, state):
+		""" Add a sample with a committed state to the current event. """
+		if state != self.evState:
+			self.closeEvent()
+			self.evState = state
+			self.evStart = s
+
+		self.evEnd = s
+		self.evLength += 1
+		self.evX += s.x
+		self.evY += s.y
+
+	def closeEvent(self):
+		if self.evLength == 0:
+			return
+
+		if self.evState == HMM.FIX:
+			# As centroid() does, move the first sample to the centroid.
+			first = self.evStart
+			first.x = round(self.evX / float(self.evLength))
+			first.y = round(self.evY / float(self.evLength))
+			self.events.append(EFixation(first, self.evLength, first, self.evEnd))
 		else:
-			p = self.normal(self.sOPm,self.sOPv,o)
-			if p == 0:
-				p = 0.0001
-			return math.log(p)
-
-	def transP(self,s1,s2):
-		if s1 == 'fix' and s2 == 'fix':
-			return self.Pff
-		if s1 == 'fix' and s2 == 'sac':
-			return self.Pfs
-		if s1 == 'sac' and s2 == 'fix':
-			return self.Psf
-		if s1 == 'sac' and s2 == 'sac':
-			return self.Pss
-
-	# Run the Viterbi algorithm to decode the HMM.
-	# Takes a list of 'observations' (read: velocities)
-	# This implementation started life as:
-	# http://en.wikipedia.org/wiki/Viterbi_algorithm
-	# Heavily modified to use log probabilities.
-	def viterbi(self, obs):
-		V = [{}]
-		path = {}
-		states = ('fix','sac')
-		start_p = {}
-		start_p['fix'] = math.log(0.55)
-		start_p['sac'] = math.log(0.45)
-	 
-		for y in states:
-			V[0][y] = start_p[y] + self.emitP(y,obs[0])
-			path[y] = [y]
-	 
-		for t in range(1,len(obs)):
-			V.append({})
-			newpath = {}
-	 
-			for y in states:
-				(prob, state) = max([(V[t-1][y0] + self.transP(y0,y) + self.emitP(y,obs[t]), y0) for y0 in states])
-				V[t][y] = prob
-				newpath[y] = path[state] + [y]
-	 
-			# Don't need to remember the old paths
-			path = newpath
-	 
-		(prob, state) = max([(V[len(obs) - 1][y], y) for y in states])
-		return (prob, path[state])
+			self.events.append(ESaccade(self.evLength, self.evStart, self.evEnd))
+
+		self.evLength = 0
+		self.evX = 0
+		self.evY = 0
+
+	def finish(self):
+		""" Online decoding: the input has run out, so commit everything. """
+		self.finished = True
+
+		if len(self.pending) > 0:
+			(f, s) = self.scores
+			self.commit(len(self.pending) - 1, HMM.SAC if s >= f else HMM.FIX)
+
+		self.closeEvent()
+
+	def nextOnline(self):
+		while len(self.events) == 0:
+			if self.finished:
+				raise StopIteration
 
+			try:
+				curr = self.input.next()
+			except StopIteration:
+				self.finish()
+				continue
+
+			self.observe(curr)
+
+		return self.events.popleft()
 
 	def next(self):
-		# Check if there is pre-computed output that can be returned.
-		if len(self.output) > 0:
-			return self.output.pop(0)
-
-		# 'exhausted' is used to signal there is no more output,
-		# and to prevent it from trying to recompute more.
-		if self.exhausted:
-			raise StopIteration
-
-		# Calls to 'next' should only reach this point *once*.
-		obs = [] # Observations
-		inp = [] # Input buffer
-
-		states = ('fix','sacc')
-		
-		for curr in self.input:
-			v = self.intersampleVelocity(self.prev,curr)
-			obs.append(v)
-			inp.append(self.prev)
-			self.prev = curr
-
-		(pr,V) = self.viterbi(obs)
-
-		inFix = True
-		event = []
-
-		for i in range(0,len(V)):
-			if V[i] == 'fix' and inFix:
-				event.append(inp[i])
-
-			elif V[i] == 'sac' and not inFix:
-				event.append(inp[i])
-
-			elif V[i] == 'fix' and not inFix:
-				e = ESaccade(len(event),event[0],event[len(event)-1])
-				self.output.append(e)
-				event = [inp[i]]
-				inFix = True
-
-			elif V[i] == 'sac' and inFix:
-				c = self.centroid(event)
-				e = EFixation(c,len(event),event[0],event[len(event)-1])
-				self.output.append(e)
-				event = [inp[i]]
-				inFix = False
-
-		# Remaining samples need to be parsed out into an event.
-		if len(event) > 0:
-			if not inFix:
-				e = ESaccade(len(event),event[0],event[len(event)-1])
-				self.output.append(e)
+		if self.lag is not None:
+			return self.nextOnline()
 
+		# Calls to 'next' should only decode *once*; after that, events
+		# come from the cached output.
+		if self.output is None:
+			try:
+				block = readBlock(self.input)
+			except StopIteration:
+				self.output = iter([])
 			else:
-				c = self.centroid(event)
-				e = EFixation(c,len(event),event[0],event[len(event)-1])
-				self.output.append(e)
+				self.output = iter(self.processBlock(block))
 
+		return self.output.next()
 
-		self.exhausted = True
-		
-		if len(self.output) > 0:
-			return self.output.pop(0)
-		else:
-			raise StopIteration
+def trainingObservations(recording):
+	"""Observations for training from a SampleBlock, a sample stream, or
+	   an array of velocities."""
+	if isinstance(recording, np.ndarray):
+		return recording.astype(float)
+
+	if not isinstance(recording, sample.SampleBlock):
+		recording = readBlock(recording)
+
+	return intersampleVelocities(recording)
+
+def segmentObservations(recordings, segmentLength):
+	"""Cut each recording into segments of up to segmentLength samples,
+	   stacked into a (segments x segmentLength) array with a mask of the
+	   valid entries."""
+	pieces = []
+	for obs in recordings:
+		for i in xrange(0, len(obs), segmentLength):
+			pieces.append(obs[i:i + segmentLength])
+
+	if len(pieces) == 0:
+		raise ValueError("No observations to train on")
+
+	length = max(len(p) for p in pieces)
+	obs = np.zeros((len(pieces), length))
+	mask = np.zeros((len(pieces), length), dtype=bool)
+
+	for (k, p) in enumerate(pieces):
+		obs[k, :len(p)] = p
+		mask[k, :len(p)] = True
+
+	return (obs, mask)
+
+def initialParameters(obs):
+	"""A starting point for training: fixations from the slower half of
+	   the observations, saccades from the fastest tenth."""
+	v = np.sort(obs)
+	slow = v[:max(1, len(v) // 2)]
+	fast = v[-max(1, len(v) // 10):]
+
+	return (slow.mean(), max(slow.std(), 1e-6), fast.mean(), max(fast.std(), 1e-6), 0.95, 0.05, 0.95, 0.05)
+
+def expectedCounts(obs, mask, mu, sigma, A, pi):
+	"""One forward-backward pass over a batch of segments.
+
+	   Returns the log-likelihood and the sums re-estimation needs: the
+	   expected initial states, state occupancy, observation sums and
+	   squared deviations from 'mu' per state, and transition counts."""
+	# Time runs along the first axis, so each step works on contiguous
+	# rows.
+	obs = np.ascontiguousarray(obs.T)
+	pad = ~mask.T
+	(L, S) = obs.shape
+
+	# Emission likelihoods, rescaled per step so the larger is 1; a
+	# per-step constant does not change the posteriors.  Padding past the
+	# end of a segment emits 1 in both states, which keeps the scale and
+	# beta at 1 there, so the passes need no special case for it.
+	(fix, sac) = [-np.square(obs - mu[k]) / (2.0 * sigma[k] * sigma[k]) - math.log(sigma[k] * math.sqrt(2.0 * math.pi))
+	              for k in (0, 1)]
+	logBmax = np.maximum(fix, sac)
+	d = sac - fix
+	B = np.empty((L, S, 2))
+	B[:, :, 0] = np.exp(np.minimum(d, 0.0))
+	B[:, :, 1] = np.exp(np.minimum(-d, 0.0))
+	B[pad] = 1.0
+	logBmax[pad] = 0.0
+	del fix, sac, d
+
+	# Forward pass.
+	alpha = np.empty((L, S, 2))
+	scale = np.empty((L, S))
+
+	a = pi * B[0]
+	scale[0] = a.sum(axis=1)
+	alpha[0] = a / scale[0, :, None]
+
+	for t in xrange(1, L):
+		a = np.dot(alpha[t - 1], A)
+		a *= B[t]
+		a.sum(axis=1, out=scale[t])
+		np.divide(a, scale[t, :, None], out=alpha[t])
+
+	ll = np.log(scale).sum() + logBmax.sum()
+
+	# Backward pass, with the forward pass's scaling.  B is overwritten
+	# with B * beta / scale, the factor the transition counts need.
+	beta = np.empty((L, S, 2))
+	beta[L - 1] = 1.0
+
+	for t in xrange(L - 1, 0, -1):
+		B[t] *= beta[t]
+		B[t] /= scale[t, :, None]
+		np.dot(B[t], A.T, out=beta[t - 1])
+
+	# Expected transitions, summed with one product rather than per
+	# step; transitions into padding count for nothing.
+	B[pad] = 0.0
+	xi = np.dot(alpha[:-1].reshape(-1, 2).T, B[1:].reshape(-1, 2)) * A
+
+	# State posteriors, zero on padding.
+	gamma = alpha
+	gamma *= beta
+	gamma /= gamma.sum(axis=2)[:, :, None]
+	gamma[pad] = 0.0
+	gamma = gamma.reshape(-1, 2)
+	x = obs.ravel()
+
+	return (ll, [gamma[:S].sum(axis=0), gamma.sum(axis=0), np.dot(x, gamma),
+	             np.dot(np.square(x - mu[:, None]), gamma).diagonal(), xi])
+
+def trainHMM(recordings, initial=None, iterations=100, tolerance=1e-6, segmentLength=1000, batchSize=1 << 18):
+	"""Fit HMM parameters to one or more recordings with Baum-Welch (EM).
+
+	   'recordings' is a SampleBlock, a sample stream or an array of
+	   velocities, or a list or tuple of those.  Returns the eight HMM
+	   parameters in constructor order, (fOPm, fOPv, sOPm, sOPv, Pff, Pfs,
+	   Pss, Psf), so a trained detector is HMM(stream, *trainHMM(recordings)).
+	   As in HMM, the 'variance' parameters are standard deviations.
+
+	   Training starts from 'initial' (in the same form) if given, and
+	   otherwise from a split of the observed velocities.  It stops after
+	   'iterations' rounds or when the log-likelihood improves by less
+	   than 'tolerance' per observation.
+
+	   The forward-backward passes are vectorised across recordings:
+	   every recording is cut into segments of segmentLength samples, and
+	   segments are processed together, one time step at a time, in
+	   batches of about batchSize samples.  Only the expected counts are
+	   kept between batches, so beyond the observations themselves,
+	   memory is bounded by the batch size rather than the corpus.
+	   Each segment starts its own state chain, which has a negligible
+	   effect on the fit for segments of a few hundred samples or more.
+	   Emissions are computed in log space and the passes use per-step
+	   scaling, so nothing underflows.
+	"""
+	if not isinstance(recordings, (list, tuple)):
+		recordings = [recordings]
+
+	data = [trainingObservations(r) for r in recordings]
+	(obs, mask) = segmentObservations(data, segmentLength)
+	(S, L) = obs.shape
+	total = mask.sum()
+	rows = max(1, batchSize // L)
+
+	if initial is None:
+		initial = initialParameters(np.concatenate(data))
+
+	(fm, fv, sm, sv, Pff, Pfs, Pss, Psf) = initial
+	mu = np.array([fm, sm], dtype=float)
+	sigma = np.array([fv, sv], dtype=float)
+	A = np.array([[Pff, Pfs], [Psf, Pss]], dtype=float)
+	A = A / A.sum(axis=1)[:, None]
+	pi = np.array([0.55, 0.45])
+	prevLL = None
+
+	for it in xrange(iterations):
+		ll = 0.0
+		counts = [np.zeros(2), np.zeros(2), np.zeros(2), np.zeros(2), np.zeros((2, 2))]
+
+		for b in xrange(0, S, rows):
+			(batchLL, batchCounts) = expectedCounts(obs[b:b + rows], mask[b:b + rows], mu, sigma, A, pi)
+			ll += batchLL
+			for (c, part) in zip(counts, batchCounts):
+				c += part
+
+		(first, occupancy, sums, squares, xi) = counts
+
+		# Re-estimate.  The squared deviations are about the old means.
+		pi = first / S
+		A = xi / xi.sum(axis=1)[:, None]
+		newMu = sums / occupancy
+		var = squares / occupancy - np.square(newMu - mu)
+		mu = newMu
+		sigma = np.sqrt(np.maximum(var, 1e-12))
+
+		if prevLL is not None and ll - prevLL < tolerance * total:
+			break
+		prevLL = ll
+
+	# Keep the slower state as the fixation state.
+	if mu[0] > mu[1]:
+		mu = mu[::-1]
+		sigma = sigma[::-1]
+		A = A[::-1, ::-1]
 
+	return (mu[0], sigma[0], mu[1], sigma[1], A[0, 0], A[0, 1], A[1, 1], A[1, 0])
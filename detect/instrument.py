@@ -0,0 +1,148 @@
+###############################################################################
+# Event Detection Algorithm Suite
+#  Copyright (C) 2012 Gian Perrone (http://github.com/gian)
+#  
+#  Permission to use, copy, modify, and distribute this software and its
+#  documentation for any purpose and without fee is hereby granted,
+#  provided that the above copyright notice appear in all copies and that
+#  both the copyright notice and this permission notice and warranty
+#  disclaimer appear in supporting documentation, and that the name of
+#  the above copyright holders, or their entities, not be used in
+#  advertising or publicity pertaining to distribution of the software
+#  without specific, written prior permission.
+#  
+#  The above copyright holders disclaim all warranties with regard to
+#  this software, including all implied warranties of merchantability and
+#  fitness. In no event shall the above copyright holders be liable for
+#  any special, indirect or consequential damages or any damages
+#  whatsoever resulting from loss of use, data or profits, whether in an
+#  action of contract, negligence or other tortious action, arising out
+#  of or in connection with the use or performance of this software.
+###############################################################################
+
+import time
+
+class StageStats(object):
+	"""What a Probe has seen of one stage.
+
+	   samplesIn: samples the stage consumed (or None if its input is not
+	      probed, in per-sample mode).
+	   eventsOut: samples or events the stage produced.
+	   wallTime, cpuTime: (seconds) time spent in the stage's own code,
+	      excluding the probed stages it pulled from.
+	   totalWallTime, totalCpuTime: (seconds) the same, including them.
+	   peakBuffers: the largest length seen for each of the stage's
+	      buffers ('window', 'buf', 'event', 'events', 'output').
+	"""
+	def __init__(self, name):
+		self.name = name
+		self.samplesIn = None
+		self.eventsOut = 0
+		self.wallTime = 0.0
+		self.cpuTime = 0.0
+		self.totalWallTime = 0.0
+		self.totalCpuTime = 0.0
+		self.peakBuffers = {}
+
+	def __str__(self):
+		rate = ""
+		if self.samplesIn and self.wallTime > 0:
+			rate = " (%.0f samples/s)" % (self.samplesIn / self.wallTime)
+
+		buffers = ", ".join("%s %d" % b for b in sorted(self.peakBuffers.items()))
+
+		return "%s: in %s, out %d, wall %.4fs, cpu %.4fs%s%s" % (
+			self.name, self.samplesIn, self.eventsOut, self.wallTime, self.cpuTime,
+			rate, "; peak " + buffers if buffers else "")
+
+class Probe(object):
+	"""Wrap a stage (an EventStream or a SampleStream), recording how
+	   much it reads and produces and the time it takes, in both per-sample
+	   and block mode.
+
+	   Probes that call into each other (each wrapping the input of the
+	   next stage) share 'active', so that the time of the probed stage
+	   below is taken off the time of the stage above.  An unprobed stage
+	   pays nothing; the cost of a probe is a few clock readings per call.
+	"""
+	bufferNames = ('window', 'buf', 'event', 'events', 'output')
+
+	def __init__(self, stage, upstream=None, active=None, name=None):
+		self.stage = stage
+		self.upstream = upstream
+		self.active = [] if active is None else active
+		self.stats = StageStats(name or type(stage).__name__)
+		self.buffers = [n for n in Probe.bufferNames if hasattr(stage, n)]
+		self.childWall = 0.0
+		self.childCpu = 0.0
+		self.blockSamples = 0
+
+	def __iter__(self):
+		return self
+
+	def measure(self):
+		""" Note the current length of the stage's buffers. """
+		peaks = self.stats.peakBuffers
+		for name in self.buffers:
+			b = getattr(self.stage, name)
+			if hasattr(b, '__len__'):
+				peaks[name] = max(peaks.get(name, 0), len(b))
+
+	def call(self, f, *args):
+		""" Call f, charging the time to this stage. """
+		# A stage pulling from its input is in the middle of its work, so
+		# this is when its buffers are fullest.
+		if len(self.active) > 0:
+			self.active[-1].measure()
+
+		self.active.append(self)
+		wall = time.time()
+		cpu = time.clock()
+		try:
+			return f(*args)
+		finally:
+			wall = time.time() - wall
+			cpu = time.clock() - cpu
+			self.active.pop()
+
+			s = self.stats
+			s.totalWallTime += wall
+			s.totalCpuTime += cpu
+
+			if len(self.active) > 0:
+				self.active[-1].childWall += wall
+				self.active[-1].childCpu += cpu
+
+			self.measure()
+
+	def next(self):
+		out = self.call(self.stage.next)
+		self.stats.eventsOut += 1
+		return out
+
+	def nextBlock(self, size=None):
+		block = self.call(self.stage.nextBlock, size)
+		self.stats.eventsOut += len(block)
+		return block
+
+	def hasBlockMode(self):
+		return self.stage.hasBlockMode()
+
+	def processBlock(self, block):
+		out = self.call(self.stage.processBlock, block)
+		self.blockSamples += len(block)
+		self.stats.eventsOut += len(out)
+		return out
+
+	def report(self):
+		""" The stage's StageStats, brought up to date. """
+		s = self.stats
+		s.wallTime = s.totalWallTime - self.childWall
+		s.cpuTime = s.totalCpuTime - self.childCpu
+
+		if self.upstream is not None:
+			s.samplesIn = self.upstream.stats.eventsOut
+		elif self.blockSamples > 0:
+			s.samplesIn = self.blockSamples
+
+		return s
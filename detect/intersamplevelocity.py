@@ -24,6 +24,23 @@ from . import eventstream
 from eventstream import EventStream
 
 import math
+import numpy as np
+
+def intersampleVelocities(block):
+	"""Velocity from each sample of a block to the next, one value
+	   shorter than the block.  Zero or negative time intervals give a
+	   velocity of zero."""
+	dx = np.diff(block.x)
+	dy = np.diff(block.y)
+	dt = np.diff(block.time)
+
+	d = np.sqrt(dx * dx + dy * dy)
+
+	v = np.zeros(len(d))
+	moving = dt > 0
+	v[moving] = d[moving] / dt[moving].astype(float)
+
+	return v
 
 class IntersampleVelocity(EventStream):
 	"""
@@ -33,7 +50,7 @@ class IntersampleVelocity(EventStream):
 	"""
 	def __init__(self, sampleStream):
 		super(IntersampleVelocity, self).__init__(sampleStream)
-		self.prev = self.input.next()
+		self.prev = None
 
 	def intersampleVelocity(self,prev,curr):
 		dx = curr.x - prev.x
@@ -50,6 +67,9 @@ class IntersampleVelocity(EventStream):
 		return d / float(dt)
 		
 	def next(self):
+		if self.prev is None:
+			self.prev = self.input.next()
+
 		curr = self.input.next()
 
 		curr.velocity = self.intersampleVelocity(self.prev,curr)
@@ -58,4 +78,9 @@ class IntersampleVelocity(EventStream):
 
 		return curr
 
+	def processBlock(self, block):
+		""" As with next(), the first sample of the block is only used as
+		    the starting point, so the output is one sample shorter. """
+		return block[1:].withColumns(velocity=intersampleVelocities(block))
+
 
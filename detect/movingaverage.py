@@ -23,28 +23,68 @@
 from . import eventstream
 from eventstream import EventStream
 
+import collections
+import numpy as np
+
 class MovingAverageFilter(EventStream):
 	"""
 		This is a naive smoothing filter, corresponding to an
-		n-sample moving average over gaze points.
+		n-sample moving average over gaze points.  Each output sample
+		is the first sample of the window, moved to the window's
+		centroid.
+
+		Running sums of x and y are kept over the window, so the cost
+		per sample does not depend on filterSize.
 
 		Parameters:
 			filterSize (samples)  The number of samples to average.
+			(optional) copy  Emit smoothed copies of the input samples
+			                 rather than updating them in place.
 	"""
-	def __init__(self, sampleStream, filterSize):
+	def __init__(self, sampleStream, filterSize, copy=False):
 		super(MovingAverageFilter, self).__init__(sampleStream)
-		self.window = []
+		self.window = collections.deque() # (sample, x, y), with the raw position
 		self.filterSize = filterSize
+		self.copy = copy
+		self.xs = 0
+		self.ys = 0
 
 	def next(self):
 
 		while len(self.window) < self.filterSize:
-			self.window.append(self.input.next())
+			p = self.input.next()
+			self.window.append((p, p.x, p.y))
+			self.xs = self.xs + p.x
+			self.ys = self.ys + p.y
+
+		if len(self.window) == 0:
+			raise StopIteration
 
-		p = self.centroid(self.window)
+		n = float(len(self.window))
+		xc = round(self.xs / n)
+		yc = round(self.ys / n)
 
-		# Slice off the first element.
-		self.window = self.window[1:]
+		# Drop the first element from the window and its sums.
+		(p, x, y) = self.window.popleft()
+		self.xs = self.xs - x
+		self.ys = self.ys - y
+
+		if self.copy:
+			p = p.copy()
+		p.x = xc
+		p.y = yc
 
 		return p
 
+	def processBlock(self, block):
+		""" Smooth a whole block, using cumulative sums of x and y.  As
+		    with next(), the last filterSize-1 samples, which never get
+		    a full window, are dropped.  Blocks are never modified. """
+		count = max(len(block) - self.filterSize + 1, 0)
+		starts = np.arange(count)
+		lengths = np.empty(count, dtype=np.intp)
+		lengths.fill(self.filterSize)
+
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
+
+		return block[:count].withColumns(x=xc, y=yc)
@@ -25,6 +25,7 @@ from eventstream import EventStream
 
 import math
 import random
+import numpy as np
 
 class NoiseFilter(EventStream):
 	"""
@@ -47,5 +48,14 @@ class NoiseFilter(EventStream):
 		samp.y = random.gauss(samp.y, self.noiseLevel)
 
 		return samp
-		
+
+	def processBlock(self, block):
+		""" Draw from the same generator, in the same order, as next(),
+		    so that with the same seed the two give the same noise. """
+		z = np.array([random.gauss(0.0, 1.0) for i in xrange(2 * len(block))]).reshape(-1, 2)
+
+		x = block.x + z[:, 0] * self.noiseLevel
+		y = block.y + z[:, 1] * self.noiseLevel
+
+		return block.withColumns(x=x, y=y)
 
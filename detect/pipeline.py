@@ -0,0 +1,147 @@
+###############################################################################
+# Event Detection Algorithm Suite
+#  Copyright (C) 2012 Gian Perrone (http://github.com/gian)
+#  
+#  Permission to use, copy, modify, and distribute this software and its
+#  documentation for any purpose and without fee is hereby granted,
+#  provided that the above copyright notice appear in all copies and that
+#  both the copyright notice and this permission notice and warranty
+#  disclaimer appear in supporting documentation, and that the name of
+#  the above copyright holders, or their entities, not be used in
+#  advertising or publicity pertaining to distribution of the software
+#  without specific, written prior permission.
+#  
+#  The above copyright holders disclaim all warranties with regard to
+#  this software, including all implied warranties of merchantability and
+#  fitness. In no event shall the above copyright holders be liable for
+#  any special, indirect or consequential damages or any damages
+#  whatsoever resulting from loss of use, data or profits, whether in an
+#  action of contract, negligence or other tortious action, arising out
+#  of or in connection with the use or performance of this software.
+###############################################################################
+
+from . import eventstream
+from eventstream import EventStream
+from . import instrument
+from instrument import Probe
+
+class Pipeline(EventStream):
+	"""A chain of filters ending (usually) in a detector, run in one go.
+
+	   'stages' lists the stages from the input outwards, each as a tuple
+	   of the class and its arguments after the input stream, with an
+	   optional dict of keyword arguments at the end.  For example
+
+	     Pipeline(stream, [(BlinkFilter,), (MovingAverageFilter, 9),
+	                       (IntersampleVelocity,), (Velocity, 30)])
+
+	   builds the same chain as
+
+	     Velocity(IntersampleVelocity(MovingAverageFilter(BlinkFilter(stream), 9)), 30)
+
+	   An existing chain can be wrapped with Pipeline.fromChain().
+
+	   If every stage has a block mode that gives the same output as its
+	   next() (see hasBlockMode), the whole input is read into one
+	   SampleBlock and passed through each stage's processBlock, with no
+	   per-sample calls or Sample objects in between.  Otherwise, as for
+	   online detectors, the samples are pulled through the per-sample
+	   chain as usual.  Either way, iterating over the pipeline gives the
+	   output of its last stage.
+
+	   With 'instrument' set, the input and every stage are wrapped in a
+	   Probe, and stats() reports what each of them did.  Without it, no
+	   probes are created and the stages run untouched.
+	"""
+	def __init__(self, sampleStream, stages=(), instrument=False):
+		super(Pipeline, self).__init__(sampleStream)
+		self.stages = []
+		self.probes = []
+		self.active = [] # Probes currently running, shared between them
+		self.output = None
+
+		stream = sampleStream
+		if instrument:
+			stream = self.input = self.probe(sampleStream)
+
+		for spec in stages:
+			(cls, args, kwargs) = (spec[0], list(spec[1:]), {})
+			if len(args) > 0 and isinstance(args[-1], dict):
+				kwargs = args.pop()
+
+			stream = cls(stream, *args, **kwargs)
+			if instrument:
+				stream = self.probe(stream)
+			self.stages.append(stream)
+
+	@classmethod
+	def fromChain(cls, last, instrument=False):
+		"""Wrap a chain of stages built the usual way, by following each
+		   stage's input back to the sample stream.  The chain must not
+		   have been read from yet.  With 'instrument' set, a Probe is
+		   spliced in below every stage."""
+		stages = []
+		stream = last
+		while isinstance(stream, EventStream):
+			stages.append(stream)
+			stream = stream.input
+
+		p = cls(stream)
+		if instrument:
+			stream = p.input = p.probe(stream)
+
+		for stage in reversed(stages):
+			if instrument:
+				stage.input = stream
+				stage = p.probe(stage)
+			p.stages.append(stage)
+			stream = stage
+
+		return p
+
+	def probe(self, stage):
+		"""Wrap a stage in a Probe fed by the last one made."""
+		upstream = None
+		if len(self.probes) > 0:
+			upstream = self.probes[-1]
+
+		p = Probe(stage, upstream, self.active)
+		self.probes.append(p)
+		return p
+
+	def stats(self):
+		"""A StageStats for the input and for each stage, in order, or an
+		   empty list if the pipeline is not instrumented."""
+		return [p.report() for p in self.probes]
+
+	def hasBlockMode(self):
+		"""True if every stage can process a whole block."""
+		return all(stage.hasBlockMode() for stage in self.stages)
+
+	def processBlock(self, block):
+		"""Pass a block through every stage in turn."""
+		for stage in self.stages:
+			block = stage.processBlock(block)
+
+		return block
+
+	def run(self):
+		"""Choose the fused block pass or the per-sample chain, and return
+		   an iterator over the output."""
+		if not self.hasBlockMode():
+			if len(self.stages) == 0:
+				return iter(self.input)
+			return iter(self.stages[-1])
+
+		try:
+			block = self.input.nextBlock()
+		except StopIteration:
+			return iter([])
+
+		return iter(self.processBlock(block))
+
+	def next(self):
+		if self.output is None:
+			self.output = self.run()
+
+		return self.output.next()
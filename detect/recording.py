@@ -0,0 +1,179 @@
+###############################################################################
+# Event Detection Algorithm Suite
+#  Copyright (C) 2012 Gian Perrone (http://github.com/gian)
+#  
+#  Permission to use, copy, modify, and distribute this software and its
+#  documentation for any purpose and without fee is hereby granted,
+#  provided that the above copyright notice appear in all copies and that
+#  both the copyright notice and this permission notice and warranty
+#  disclaimer appear in supporting documentation, and that the name of
+#  the above copyright holders, or their entities, not be used in
+#  advertising or publicity pertaining to distribution of the software
+#  without specific, written prior permission.
+#  
+#  The above copyright holders disclaim all warranties with regard to
+#  this software, including all implied warranties of merchantability and
+#  fitness. In no event shall the above copyright holders be liable for
+#  any special, indirect or consequential damages or any damages
+#  whatsoever resulting from loss of use, data or profits, whether in an
+#  action of contract, negligence or other tortious action, arising out
+#  of or in connection with the use or performance of this software.
+###############################################################################
+
+# Binary recording format.
+#
+# A recording file starts with a fixed-size header: an 8-byte magic string
+# followed by a JSON description of the file, padded with spaces to
+# headerSize bytes.  The description gives the sampling rate, the number of
+# samples and the schema, a list of (column name, NumPy type) pairs.  The
+# samples follow as fixed-width records in that layout, so the file can be
+# memory-mapped and used as a SampleBlock without parsing anything.
+
+from . import sample
+from sample import SampleBlock
+from sample import ListSampleStream
+from sample import FileSampleStream
+
+import json
+import numpy as np
+
+magic = 'EDREC\x00\x01\x00'
+headerSize = 4096
+
+def recordType(block):
+	"""The record layout used to store a block: the core columns first,
+	   then any others in name order."""
+	names = list(SampleBlock.coreColumns)
+	names.extend(sorted(n for n in block.columns if n not in SampleBlock.coreColumns))
+
+	return np.dtype([(n, block.columns[n].dtype.str) for n in names])
+
+def writeHeader(handle, dtype, count, rate):
+	desc = {
+		'rate': rate,
+		'count': count,
+		'columns': [(n, dtype.fields[n][0].str) for n in dtype.names],
+	}
+
+	text = magic + json.dumps(desc)
+
+	if len(text) > headerSize:
+		raise ValueError("Recording schema does not fit in the header")
+
+	handle.seek(0)
+	handle.write(text.ljust(headerSize))
+
+def readHeader(filename):
+	"""Return the (dtype, count, rate) stored in a recording's header."""
+	handle = open(filename, 'rb')
+	text = handle.read(headerSize)
+	handle.close()
+
+	if len(text) < headerSize or text[:len(magic)] != magic:
+		raise ValueError("%s is not a recording file" % filename)
+
+	desc = json.loads(text[len(magic):].rstrip())
+	dtype = np.dtype([(str(n), str(t)) for (n, t) in desc['columns']])
+
+	return (dtype, desc['count'], desc['rate'])
+
+def writeRecording(filename, blocks, rate):
+	"""Write an iterable of SampleBlocks out as a recording file.
+
+	   All blocks must have the columns of the first one."""
+	handle = open(filename, 'wb')
+	handle.write('\0' * headerSize)
+
+	dtype = None
+	count = 0
+
+	for b in blocks:
+		if dtype is None:
+			dtype = recordType(b)
+
+		records = np.empty(len(b), dtype=dtype)
+		for n in dtype.names:
+			records[n] = b.columns[n]
+
+		records.tofile(handle)
+		count = count + len(b)
+
+	if dtype is None:
+		dtype = recordType(SampleBlock([], [], [], []))
+
+	writeHeader(handle, dtype, count, rate)
+	handle.close()
+
+def estimateRate(block, timeScale):
+	dt = np.diff(block.time)
+	dt = dt[dt > 0]
+
+	if len(dt) == 0:
+		return None
+
+	return timeScale / float(np.median(dt))
+
+def convertRecording(source, target, rate=None, timeScale=1000000.0):
+	"""Convert a tab-separated recording (as read by FileSampleStream)
+	   to the binary format.
+
+	   The file is converted a chunk at a time.  If no sampling rate (Hz) is
+	   given it is estimated from the median interval between samples, with
+	   timestamps taken to be in units of 1/timeScale seconds."""
+	stream = FileSampleStream(source)
+	blocks = stream.blocks(1 << 16)
+
+	try:
+		first = blocks.next()
+	except StopIteration:
+		writeRecording(target, [], rate)
+		return
+
+	if rate is None:
+		rate = estimateRate(first, timeScale)
+
+	def chain():
+		yield first
+		for b in blocks:
+			yield b
+
+	writeRecording(target, chain(), rate)
+
+def mapRecords(filename, dtype, count):
+	if count == 0:
+		return np.zeros(0, dtype=dtype)
+
+	return np.memmap(filename, dtype=dtype, mode='r', offset=headerSize, shape=(count,))
+
+def mapRecording(filename):
+	"""Memory-map a recording file as a read-only SampleBlock."""
+	(dtype, count, rate) = readHeader(filename)
+
+	return SampleBlock.fromArray(mapRecords(filename, dtype, count))
+
+class MappedSampleStream(ListSampleStream):
+	"""A sample stream over a memory-mapped recording file.
+
+	   Nothing is read up front: pages of the file are loaded as samples
+	   are touched.  The whole recording is available as 'block' for
+	   random access, and 'rate' holds the sampling rate from the header.
+	"""
+	def __init__(self, filename):
+		(dtype, count, rate) = readHeader(filename)
+		self.rate = rate
+		self.block = SampleBlock.fromArray(mapRecords(filename, dtype, count))
+
+		super(MappedSampleStream, self).__init__(self.block)
+
+if __name__ == '__main__':
+	import sys
+
+	if len(sys.argv) not in (3, 4):
+		sys.stderr.write("Usage: python -m detect.recording input.txt output.rec [rate]\n")
+		sys.exit(1)
+
+	rate = None
+	if len(sys.argv) == 4:
+		rate = float(sys.argv[3])
+
+	convertRecording(sys.argv[1], sys.argv[2], rate)
@@ -20,14 +20,31 @@
 #  of or in connection with the use or performance of this software.
 ###############################################################################
 
-from . import eventstream
+import itertools
+import numpy as np
 
 class Sample(object):
-	def __init__(self, ind=0, time=0, x=0, y=0):
+	"""A single gaze sample.
+
+	   Samples are slotted to keep them small.  Besides the position and
+	   time, filters can fill in 'velocity', 'vx' and 'vy', and labelled
+	   recordings carry an 'eventType'; these are None until set.
+	"""
+	__slots__ = ('index', 'time', 'x', 'y', 'velocity', 'vx', 'vy', 'eventType')
+
+	def __init__(self, ind=0, time=0, x=0, y=0, velocity=None, vx=None, vy=None, eventType=None):
 		self.index = ind
 		self.time = time
 		self.x = x
 		self.y = y
+		self.velocity = velocity
+		self.vx = vx
+		self.vy = vy
+		self.eventType = eventType
+
+	def copy(self):
+		return Sample(self.index, self.time, self.x, self.y,
+		              self.velocity, self.vx, self.vy, self.eventType)
 
 	def __str__(self):
 		return "(%d,%f,%d,%d)" % (self.index, self.time, self.x, self.y)
@@ -35,6 +52,238 @@ class Sample(object):
 	def __repr__(self):
 		return self.__str__()
 
+class TimeIndex(object):
+	"""Finds samples by timestamp with binary search.
+
+	   Recordings are normally in time order, in which case the index is
+	   just the time column itself.  Otherwise the sort order is computed
+	   once and positions are mapped back through it.
+	"""
+	def __init__(self, times):
+		self.times = np.asarray(times)
+		self.order = None
+
+		if len(self.times) > 1 and np.any(self.times[1:] < self.times[:-1]):
+			self.order = np.argsort(self.times, kind='mergesort')
+			self.sorted = self.times[self.order]
+		else:
+			self.sorted = self.times
+
+	def isOrdered(self):
+		return self.order is None
+
+	def position(self, t):
+		"""The number of samples earlier than t.  For an ordered recording
+		   this is the position of the first sample at or after t."""
+		return int(np.searchsorted(self.sorted, t, side='left'))
+
+	def window(self, t0, t1):
+		"""Positions of the samples with t0 <= time < t1.
+
+		   Returns a slice for ordered recordings, and otherwise an array of
+		   positions in recording order."""
+		a = self.position(t0)
+		b = max(a, self.position(t1))
+
+		if self.order is None:
+			return slice(a, b)
+
+		return np.sort(self.order[a:b])
+
+class SampleBlock(object):
+	"""A run of samples stored column-wise in NumPy arrays.
+
+	   Every block has 'index', 'time', 'x' and 'y' columns.  Further
+	   columns (e.g. 'velocity', 'vx', 'vy' or 'eventType') can be attached
+	   by filters, and must be the same length as the block.  Columns are
+	   available as attributes, so block.x is the array of x coordinates.
+
+	   Slicing a block gives a new block whose columns are views onto the
+	   same arrays.  Indexing a single position, or iterating, gives
+	   Sample objects carrying the columns that Sample declares, so a
+	   block can be fed to any per-sample stage.
+	"""
+	coreColumns = ('index', 'time', 'x', 'y')
+	optionalColumns = ('velocity', 'vx', 'vy', 'eventType')
+
+	def __init__(self, index, time, x, y, **columns):
+		self.columns = {}
+		self.columns['index'] = np.asarray(index)
+		self.columns['time'] = np.asarray(time)
+		self.columns['x'] = np.asarray(x)
+		self.columns['y'] = np.asarray(y)
+
+		for name in columns:
+			self.columns[name] = np.asarray(columns[name])
+
+		n = len(self.columns['index'])
+
+		for name in self.columns:
+			if self.columns[name].shape != (n,):
+				raise ValueError("Column '%s' does not match the block length (%d)" % (name, n))
+
+		self.cachedTimeIndex = None
+
+	@classmethod
+	def fromSamples(cls, samples):
+		"""Build a block from a sequence of Sample objects.
+
+		   Optional columns are kept if every sample carries them."""
+		samples = list(samples)
+
+		columns = {}
+		for name in cls.coreColumns:
+			columns[name] = [getattr(s, name) for s in samples]
+
+		for name in cls.optionalColumns:
+			values = [getattr(s, name, None) for s in samples]
+			if len(values) > 0 and None not in values:
+				columns[name] = values
+
+		return cls(**columns)
+
+	@classmethod
+	def fromArray(cls, data):
+		"""Wrap a NumPy array as a block without copying it.
+
+		   A structured array supplies one column per field, named as the
+		   block columns are.  A plain two-dimensional array is read like a
+		   recording file: time, x, y and optionally eventType columns.
+		   Samples are numbered from 0 if the array carries no index."""
+		if data.dtype.names is not None:
+			columns = {}
+			for name in data.dtype.names:
+				columns[name] = data[name]
+		else:
+			if data.ndim != 2 or data.shape[1] not in (3, 4):
+				raise ValueError("Expected an array of (time, x, y[, eventType]) rows")
+
+			columns = {'time': data[:,0], 'x': data[:,1], 'y': data[:,2]}
+			if data.shape[1] == 4:
+				columns['eventType'] = data[:,3]
+
+		if 'index' not in columns:
+			columns['index'] = np.arange(len(data))
+
+		return cls(**columns)
+
+	@classmethod
+	def concatenate(cls, blocks):
+		"""Join a list of blocks end to end, keeping the columns they share."""
+		blocks = list(blocks)
+
+		if len(blocks) == 0:
+			return cls([], [], [], [])
+
+		names = set(blocks[0].columns)
+		for b in blocks[1:]:
+			names = names & set(b.columns)
+
+		columns = {}
+		for name in names:
+			columns[name] = np.concatenate([b.columns[name] for b in blocks])
+
+		return cls(**columns)
+
+	def __len__(self):
+		return len(self.columns['index'])
+
+	def __getattr__(self, name):
+		# Only called when normal attribute lookup fails.
+		try:
+			return self.__dict__['columns'][name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			columns = {}
+			for name in self.columns:
+				columns[name] = self.columns[name][i]
+			return SampleBlock(**columns)
+
+		return self.sample(i)
+
+	def __iter__(self):
+		return self.samples()
+
+	def __str__(self):
+		return "SampleBlock of %d samples (%s)" % (len(self), ", ".join(sorted(self.columns)))
+
+	def __repr__(self):
+		return self.__str__()
+
+	def timeIndex(self):
+		"""The TimeIndex over this block's time column, built on first use."""
+		if self.cachedTimeIndex is None:
+			self.cachedTimeIndex = TimeIndex(self.columns['time'])
+		return self.cachedTimeIndex
+
+	def sliceTime(self, t0, t1):
+		"""The samples with t0 <= time < t1.  For a recording in time order
+		   this is a view onto the same arrays."""
+		w = self.timeIndex().window(t0, t1)
+
+		if isinstance(w, slice):
+			return self[w]
+
+		return self.select(w)
+
+	def hasColumn(self, name):
+		return name in self.columns
+
+	def withColumns(self, **columns):
+		"""Return a block sharing this block's arrays, with columns added or replaced."""
+		merged = dict(self.columns)
+		merged.update(columns)
+		return SampleBlock(**merged)
+
+	def select(self, rows):
+		"""Return a block of the rows picked out by a boolean mask or index array."""
+		columns = {}
+		for name in self.columns:
+			columns[name] = self.columns[name][rows]
+		return SampleBlock(**columns)
+
+	def sampleColumns(self):
+		return [name for name in Sample.__slots__ if name in self.columns]
+
+	def sample(self, i):
+		"""Build a Sample object for the sample at position i."""
+		s = Sample()
+		for name in self.sampleColumns():
+			setattr(s, name, self.columns[name][i].item())
+		return s
+
+	def samples(self):
+		"""Iterate over the block as Sample objects."""
+		values = []
+		for name in Sample.__slots__:
+			if name in self.columns:
+				values.append(self.columns[name].tolist())
+			else:
+				values.append(itertools.repeat(None, len(self)))
+
+		return itertools.starmap(Sample, itertools.izip(*values))
+
+def readBlock(stream, size=None):
+	"""Read up to 'size' samples (or everything, if size is None) from
+	   a per-sample stream into a SampleBlock.
+
+	   Raises StopIteration if the stream has nothing left."""
+	samples = []
+
+	try:
+		while size is None or len(samples) < size:
+			samples.append(stream.next())
+	except StopIteration:
+		pass
+
+	if len(samples) == 0:
+		raise StopIteration
+
+	return SampleBlock.fromSamples(samples)
+
 class SampleStream(object):
 	def __init__(self):
 		raise "SampleStream shouldn't be instantiated directly. Use FileSampleStream or ListSampleStream."
@@ -45,35 +294,248 @@ class SampleStream(object):
 	def next(self):
 		raise StopIteration
 
+	def nextBlock(self, size=None):
+		"""Return the next 'size' samples (default: all remaining) as a SampleBlock."""
+		return readBlock(self, size)
+
+	def blocks(self, size=4096):
+		"""Iterate over the rest of the stream in blocks of up to 'size' samples."""
+		while True:
+			try:
+				b = self.nextBlock(size)
+			except StopIteration:
+				return
+			yield b
+
 class ListSampleStream(SampleStream):
+	"""Replays samples held in memory.
+
+	   'data' may be a sequence of Sample objects, a SampleBlock, or a
+	   NumPy array in any layout accepted by SampleBlock.fromArray.  The
+	   data is not copied: the stream keeps a cursor into it, and for block
+	   or array input nextBlock() returns views onto the original arrays.
+	"""
 	def __init__(self,data):
-		self.data = list(data)
+		if isinstance(data, np.ndarray):
+			data = SampleBlock.fromArray(data)
+		elif not hasattr(data, '__getitem__'):
+			data = list(data)
+
+		self.data = data
+		self.pos = 0
+		self.cachedTimeIndex = None
 	
 	def next(self):
-		if len(self.data) == 0:
+		if self.pos >= len(self.data):
+			raise StopIteration
+
+		s = self.data[self.pos]
+		self.pos += 1
+
+		return s
+
+	def seek(self, pos):
+		"""Move the cursor so that the next sample read is data[pos]."""
+		self.pos = pos
+
+	def timeIndex(self):
+		if isinstance(self.data, SampleBlock):
+			return self.data.timeIndex()
+
+		if self.cachedTimeIndex is None:
+			self.cachedTimeIndex = TimeIndex([s.time for s in self.data])
+		return self.cachedTimeIndex
+
+	def seekTime(self, t):
+		"""Move the cursor to the first sample at or after time t.
+
+		   The recording must be in time order."""
+		index = self.timeIndex()
+
+		if not index.isOrdered():
+			raise ValueError("seekTime needs samples in time order")
+
+		self.seek(index.position(t))
+
+	def sliceTime(self, t0, t1):
+		"""A new stream over the samples with t0 <= time < t1.
+
+		   Block and array data is not copied."""
+		if isinstance(self.data, SampleBlock):
+			return ListSampleStream(self.data.sliceTime(t0, t1))
+
+		w = self.timeIndex().window(t0, t1)
+
+		if isinstance(w, slice):
+			return ListSampleStream(self.data[w])
+
+		return ListSampleStream([self.data[i] for i in w])
+
+	def nextBlock(self, size=None):
+		if not isinstance(self.data, SampleBlock):
+			return super(ListSampleStream, self).nextBlock(size)
+
+		if self.pos >= len(self.data):
 			raise StopIteration
 
-		return self.data.pop(0)
+		end = len(self.data)
+		if size is not None:
+			end = min(end, self.pos + size)
+
+		b = self.data[self.pos:end]
+		self.pos = end
+
+		return b
+
+def fieldCounts(text):
+	"""The number of tab-separated fields on each non-blank line of text."""
+	buf = np.frombuffer(text, dtype=np.uint8)
+	ends = np.flatnonzero(buf == ord('\n'))
+	if len(buf) > 0 and buf[-1] != ord('\n'):
+		ends = np.append(ends, len(buf))
+	starts = np.concatenate(([0], ends[:-1] + 1))
+
+	tabs = np.flatnonzero(buf == ord('\t'))
+	counts = np.searchsorted(tabs, ends) - np.searchsorted(tabs, starts) + 1
+
+	# Only lines without tabs can be blank.
+	blank = [i for i in np.flatnonzero(counts == 1) if text[starts[i]:ends[i]].strip() == '']
+
+	return np.delete(counts, blank)
+
+def parseSampleText(text, firstIndex=1, width=None):
+	"""Parse whole lines of a tab-separated recording (time, x, y,
+	   eventType, all integers) into a SampleBlock, numbering the samples
+	   from firstIndex.
+
+	   Rows may carry further columns, which are ignored, but every row
+	   must have 'width' fields; by default as many as the first row."""
+	fields = fieldCounts(text)
+	if width is None:
+		width = fields[0] if len(fields) > 0 else len(FileSampleStream.fileColumns)
+
+	if width < len(FileSampleStream.fileColumns):
+		raise ValueError("Recording has %d columns, expected at least %d" % (width, len(FileSampleStream.fileColumns)))
+
+	values = np.fromstring(text, dtype=np.int64, sep=' ')
+
+	if np.any(fields != width) or len(values) != len(fields) * width:
+		# Find the offending line for the message.
+		lines = [l for l in text.split('\n') if l.strip() != '']
+		for (i, line) in enumerate(lines):
+			f = line.split('\t')
+			try:
+				ok = len(f) == width and [int(v) for v in f]
+			except ValueError:
+				ok = False
+			if not ok:
+				raise ValueError("Malformed sample %d: %r" % (firstIndex + i, line))
+		raise ValueError("Malformed sample data after sample %d" % firstIndex)
+
+	rows = values.reshape(-1, width)
+
+	columns = {}
+	for i, name in enumerate(FileSampleStream.fileColumns):
+		columns[name] = rows[:,i]
+
+	columns['index'] = np.arange(firstIndex, firstIndex + len(rows))
+
+	return SampleBlock(**columns)
 
 class FileSampleStream(SampleStream):
-	def __init__(self,filename):
+	"""Reads a tab-separated recording with a header line, and one
+	   time, x, y, eventType row per sample.
+
+	   The file is read in chunks of about 'chunkSize' bytes, each parsed
+	   straight into NumPy arrays.  next() hands out Sample objects from the
+	   current chunk; nextBlock() hands out the arrays themselves.  The two
+	   can be mixed freely.
+	"""
+	fileColumns = ('time', 'x', 'y', 'eventType')
+
+	def __init__(self, filename, chunkSize=1 << 20):
 		self.handle = open(filename, 'r')
 		self.handle.readline() # skip header
 		self.index = 0
+		self.chunkSize = chunkSize
+		self.remainder = ''
+		self.width = None
+		self.block = None
+		self.samples = None
+		self.pos = 0
 
-	def next(self):
-		line = self.handle.readline()
-		if line == '':
-			raise StopIteration
+	def readChunk(self):
+		""" Parse the next chunk of whole lines into self.block. """
+		while True:
+			if self.handle.closed:
+				raise StopIteration
 
-		f = line.split('\t')
+			data = self.handle.read(self.chunkSize)
 
-		self.index = self.index + 1
+			if data == '':
+				# Whatever is left over is a final line with no newline.
+				self.handle.close()
+				text = self.remainder
+				self.remainder = ''
+			else:
+				text = self.remainder + data
+				cut = text.rfind('\n') + 1
+				self.remainder = text[cut:]
+				text = text[:cut]
 
-		t = float(f[0]) / 1000000.0 # Microseconds to seconds
+			if text.strip() == '':
+				continue
 
-		s = Sample(self.index, int(f[0]), int(f[1]), int(f[2]))
-		s.eventType = int(f[3][:-1])
+			if self.width is None:
+				# Every row has as many columns as the first.
+				self.width = fieldCounts(text)[0]
+
+			self.block = parseSampleText(text, self.index + 1, self.width)
+			self.samples = None
+			self.pos = 0
+			self.index = self.index + len(self.block)
+			return
+
+	def next(self):
+		while self.block is None or self.pos >= len(self.block):
+			self.readChunk()
+
+		if self.samples is None:
+			self.samples = list(self.block.samples())
+
+		s = self.samples[self.pos]
+		self.pos += 1
 
 		return s
 
+	def nextBlock(self, size=None):
+		parts = []
+		n = 0
+
+		while size is None or n < size:
+			if self.block is None or self.pos >= len(self.block):
+				try:
+					self.readChunk()
+				except StopIteration:
+					break
+
+			end = len(self.block)
+			if size is not None:
+				end = min(end, self.pos + size - n)
+
+			parts.append(self.block[self.pos:end])
+			n += end - self.pos
+			self.pos = end
+
+		if n == 0:
+			raise StopIteration
+
+		if len(parts) == 1:
+			return parts[0]
+
+		return SampleBlock.concatenate(parts)
+
+def readSampleFile(filename):
+	"""Load a whole tab-separated recording into a single SampleBlock."""
+	return FileSampleStream(filename).nextBlock()
+
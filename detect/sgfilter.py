@@ -5,6 +5,43 @@
 from . import eventstream
 from eventstream import EventStream
 
+import collections
+import operator
+import numpy as np
+
+# Filter coefficients, keyed by (window_size, order, deriv, rate).
+sgCache = {}
+
+def sgCoefficients(window_size, order, deriv=0, rate=1):
+	"""The convolution coefficients for a Savitzky-Golay filter.
+
+	   These are computed once for each combination of parameters and
+	   then reused.  Applying them to y[i:i+window_size] (padded as in
+	   savitzky_golay) gives the filtered value for sample i."""
+	from math import factorial
+
+	key = (window_size, order, deriv, rate)
+	if key in sgCache:
+		return sgCache[key]
+
+	try:
+		window_size = np.abs(np.int(window_size))
+		order = np.abs(np.int(order))
+	except ValueError, msg:
+		raise ValueError("window_size and order have to be of type int")
+	if window_size % 2 != 1 or window_size < 1:
+		raise TypeError("window_size size must be a positive odd number")
+	if window_size < order + 2:
+		raise TypeError("window_size is too small for the polynomials order")
+	order_range = range(order+1)
+	half_window = (window_size -1) // 2
+	# precompute coefficients
+	b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
+	m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
+
+	sgCache[key] = m
+	return m
+
 def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 	r"""Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
 	The Savitzky-Golay filter removes high frequency noise from data.
@@ -53,23 +90,10 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 	   W.H. Press, S.A. Teukolsky, W.T. Vetterling, B.P. Flannery
 	   Cambridge University Press ISBN-13: 9780521880688
 	"""
-	import numpy as np
-	from math import factorial
-
-	try:
-		window_size = np.abs(np.int(window_size))
-		order = np.abs(np.int(order))
-	except ValueError, msg:
-		raise ValueError("window_size and order have to be of type int")
-	if window_size % 2 != 1 or window_size < 1:
-		raise TypeError("window_size size must be a positive odd number")
-	if window_size < order + 2:
-		raise TypeError("window_size is too small for the polynomials order")
-	order_range = range(order+1)
-	half_window = (window_size -1) // 2
-	# precompute coefficients
-	b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-	m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
+	m = sgCoefficients(window_size, order, deriv, rate)
+	half_window = (len(m) - 1) // 2
+	if len(y) <= half_window:
+		raise TypeError("the signal is too short for window_size")
 	# pad the signal at the extremes with
 	# values taken from the signal itself
 	firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
@@ -77,50 +101,107 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 	y = np.concatenate((firstvals, y, lastvals))
 	return np.convolve( m[::-1], y, mode='valid')
 
-import numpy as np
-
 class SGFilter(EventStream):
 	"""
 	    An EventStream implementation of an SG filter.
 
-	    Expects an input stream of samples with a 'velocity'
-	    component, which are really just magnitudes.
+	    By default this expects an input stream of samples with a
+	    'velocity' component, which are really just magnitudes, and
+	    outputs the same stream with the velocity component filtered.
+	    Other components (such as 'x' and 'y') can be filtered instead.
 
-	    Outputs the same input stream with a modified velocity component.
+	    The filter runs online: each sample is emitted as soon as the half
+	    window of samples after it has been read, and only a window's worth
+	    of samples is held.  The ends of the input are padded as in
+	    savitzky_golay, so the output matches filtering the whole signal.
 
 	    Parameters:
 	      windowSize (samples)
 	      order Order of the polynomial to use
 	      (optional) deriv the order of the derivative to compute.
+	      (optional) columns the sample components to filter.
+	      (optional) rate the sampling rate, which scales derivatives.
 
 	"""
-	def __init__(self, sampleStream, windowSize, order, deriv=0):
+	def __init__(self, sampleStream, windowSize, order, deriv=0, columns=('velocity',), rate=1):
 		super(SGFilter, self).__init__(sampleStream)
 		self.windowSize = windowSize
 		self.order = order
 		self.deriv = deriv
-		self.buf = []
-		velocities = []
-		self.index = 0
-
-		for s in sampleStream:
-			self.buf.append(s)
-			velocities.append(s.velocity)
-
-		self.sgVelocities = savitzky_golay(np.array(velocities), self.windowSize, self.order, self.deriv)
-
+		self.columns = columns
+		self.rate = rate
+		self.coeffs = sgCoefficients(windowSize, order, deriv, rate).tolist()
+		self.half = (windowSize - 1) // 2
+		self.buf = collections.deque() # Samples read but not yet emitted
+		self.windows = None # Padded input values, one deque per column
+		self.tails = None # Padding for the end of the input
+
+	def start(self):
+		""" Read the first half window and pad the start of the signal. """
+		try:
+			while len(self.buf) <= self.half:
+				self.buf.append(self.input.next())
+		except StopIteration:
+			if len(self.buf) > 0:
+				raise TypeError("the signal is too short for window_size")
+			raise
+
+		self.windows = []
+
+		for c in self.columns:
+			y = [getattr(s, c) for s in self.buf]
+			w = collections.deque(maxlen=self.windowSize)
+			w.extend(y[0] - abs(v - y[0]) for v in reversed(y[1:]))
+			w.extend(y)
+			self.windows.append(w)
+
+	def advance(self):
+		""" Slide the windows on by one: the next input value, or once the
+		    input has run out, the next value of the end padding. """
+		if self.tails is None:
+			try:
+				s = self.input.next()
+			except StopIteration:
+				self.tails = []
+				for w in self.windows:
+					last = w[-1]
+					tail = list(w)[-self.half - 1:-1]
+					self.tails.append(collections.deque(last + abs(v - last) for v in reversed(tail)))
+			else:
+				self.buf.append(s)
+				for (c, w) in zip(self.columns, self.windows):
+					w.append(getattr(s, c))
+				return
+
+		for (w, tail) in zip(self.windows, self.tails):
+			if len(tail) > 0:
+				w.append(tail.popleft())
 
 	def next(self):
-		if self.index >= len(self.buf):
+		if self.windows is None:
+			self.start()
+
+		if len(self.buf) == 0:
 			raise StopIteration
 
-		s = self.buf[self.index]
-		s.velocity = self.sgVelocities[self.index]
-		self.index = self.index + 1
+		# The windows now cover the oldest buffered sample.
+		s = self.buf.popleft()
+		for (c, w) in zip(self.columns, self.windows):
+			setattr(s, c, sum(map(operator.mul, self.coeffs, w)))
 
-		return s
+		self.advance()
 
-		
+		return s
 
+	def processBlock(self, block):
+		""" Filter whole columns of a block, one convolution per column. """
+		if len(block) == 0:
+			# next() has nothing to pad and emits nothing.
+			return block
 
+		columns = {}
+		for c in self.columns:
+			columns[c] = savitzky_golay(np.asarray(block.columns[c], dtype=float),
+			                            self.windowSize, self.order, self.deriv, self.rate)
 
+		return block.withColumns(**columns)
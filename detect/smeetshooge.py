@@ -24,9 +24,24 @@ from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
 from eventstream import ESaccade
+from eventstream import EventTable
+from sample import readBlock
+import collections
 import math
 import numpy as np
 
+def firstBelow(v, start, t):
+	""" The first position from 'start' on where v is below t, or len(v). """
+	step = 64
+	while start < len(v):
+		below = np.flatnonzero(v[start:start + step] < t)
+		if len(below) > 0:
+			return start + below[0]
+		start += step
+		step *= 2
+
+	return len(v)
+
 class SmeetsHooge(EventStream):
 	"""A velocity threshold-based algorithm, based on "Nature of Variability
 	   in Saccades" by Smeets and Hooge (2003).
@@ -50,218 +65,352 @@ class SmeetsHooge(EventStream):
 	   calculate saccade onset and offset (the saccade onset is when it reaches
 	   3 standard deviations beyond this mean).
 
-	   Note that this algorithm is completely offline.  It needs to be able to
+	   By default this algorithm is completely offline.  It needs to be able to
 	   seek forward and back arbitrary amounts, therefore it is implemented
-	   as a single buffered pass over the input stream.  An online variant
-	   is possible, but it is not implemented here for simplicity.
+	   as a single buffered pass over the input stream.
+
+	   Given a 'horizon' (in samples), it runs online instead.  Only the
+	   last windowSize + windowOffset velocities are kept for baselines,
+	   and the end of a saccade is only searched for up to 'horizon'
+	   samples past a threshold crossing.  Samples are read at most
+	   horizon + windowSize samples ahead, events are returned as soon as
+	   they close, and memory use does not grow with the recording.  If
+	   every search ends within the horizon, the events are the same as
+	   offline.
+
+	   Velocities and markers are kept in arrays.  The baseline mean and
+	   standard deviation for every sample come from prefix sums of v and
+	   v^2, so each threshold crossing costs O(windowSize + windowOffset)
+	   for its marking rather than a fresh pass over the baseline window.
 
 	   Parameters:
 		velThresh (pixels/s) The velocity above which to mark a possible saccade.
 		windowOffset: The number of samples before the threshold crossing to sample.
 		windowSize: the size of the baseline window (in samples).
+		(optional) horizon: run online, searching at most this many samples ahead.
 	"""
-	def __init__(self, sampleStream, velThresh, windowSize, windowOffset):
+	def __init__(self, sampleStream, velThresh, windowSize, windowOffset, horizon=None):
 		super(SmeetsHooge, self).__init__(sampleStream)
 		self.windowSize = windowSize
 		self.velThresh = velThresh
 		self.windowOffset = windowOffset
-		self.window = []
-		self.velocities = dict()
-		self.marker = dict()
-		self.events = []
+		self.horizon = horizon
+		self.output = None
+
+		# Online state.  Samples from position 'base' on are kept, with
+		# their velocities and markers.
+		self.samples = []
+		self.velocities = []
+		self.marker = []
+		self.base = 0
+		self.pos = 0 # Next position to handle as a possible crossing
+		self.done = 0 # Next position to pass to the current event
 		self.exhausted = False
+		self.events = collections.deque()
+		self.event = None # [type, first, last, length, xsum, ysum]
+		self.resume = None # (position, threshold) while in a saccade
+
+	def markVelocity(self, block):
+		""" Computes inter-sample velocities, with 0 for the first sample. """
+		v = np.zeros(len(block))
+
+		if len(block) > 1:
+			dt = np.diff(block.time).astype(float)
+			dt[dt == 0] = 1
+			v[1:] = np.hypot(np.diff(block.x), np.diff(block.y)) / dt
+
+		return v
+
+	def baselines(self, v):
+		""" The onset threshold (mean + 3 SD of the baseline window) for a
+		    crossing at each sample, from prefix sums of v and v^2.  Samples
+		    without a full baseline window get NaN. """
+		n = len(v)
+		lead = self.windowSize + self.windowOffset
+		thresh = np.full(n, np.nan)
+
+		# The baseline for a crossing at i is the velocity of the samples
+		# i - lead + 1 ... i - windowOffset - 1.
+		count = self.windowSize - 1
+
+		if n <= lead:
+			return thresh
+
+		if count <= 0:
+			thresh[lead:] = 0.0
+			return thresh
+
+		# Sums of squares lose precision far from zero, so work relative
+		# to the mean.
+		shift = v.mean()
+		u = v - shift
+		s1 = np.concatenate(([0.0], np.cumsum(u)))
+		s2 = np.concatenate(([0.0], np.cumsum(u * u)))
+
+		i = np.arange(lead, n)
+		(a, b) = (i - lead + 1, i - self.windowOffset)
+		mean = (s1[b] - s1[a]) / count
+		var = (s2[b] - s2[a]) / count - mean * mean
+
+		# Windows of equal velocities (stationary gaze, or a baseline of
+		# one sample) have a standard deviation of exactly zero, but
+		# cancellation in the sums leaves a little rounding error, which
+		# the square root magnifies.  Snap those to the exact values.
+		tol = 4 * np.finfo(float).eps * ((np.abs(s2[a]) + np.abs(s2[b])) +
+		                                 2 * np.abs(mean) * (np.abs(s1[a]) + np.abs(s1[b]))) / count
+		flat = var <= tol
+		var[flat] = 0
+		mean = mean + shift
+		mean[flat] = v[a[flat]]
+
+		thresh[lead:] = 3 * np.sqrt(var) + mean
+		return thresh
+
+	def markSegments(self, v):
+		""" Marks saccadic samples, expanding each threshold crossing by
+		    the baseline thresholds.  Returns an array of 0/1 markers. """
+		n = len(v)
+		marker = (v > self.velThresh).astype(np.int8)
+		if n > 0:
+			marker[0] = 0
+
+		thresh = self.baselines(v)
+		lead = self.windowSize + self.windowOffset
+
+		# Markers from 'written' on still have their initial values, so
+		# beyond it the next marked sample is the next crossing.
+		crossings = np.flatnonzero(v > self.velThresh)
+		written = 0
+		resume = 0 # Crossings before this are inside a saccade
+
+		# Crossings are handled in order, each overwriting the markers
+		# around it, so this part stays sequential.
+		for i in crossings:
+			if i < lead or i < resume:
+				# We don't have enough samples for a baseline, or
+				# are still in the last saccade
+				continue
 
-	def fillWindow(self):
-		try:
-			while True:
-				self.window.append(self.input.next())
-		except StopIteration:
-			return
-
-	def markVelocity(self):
-		if len(self.window) == 0:
-			return
-
-		""" Marks the set of samples with eventType tags based on velocity. """
-		prev = self.window[0]
-
-		dsum = 0
-		interval = 0
-
-		self.velocities[0] = 0.0
-		self.marker[0] = 0
-
-		for i in range(1, len(self.window)):
-			curr = self.window[i]
-
-			dx = curr.x - prev.x
-			dy = curr.y - prev.y
-			dt = curr.time - prev.time
-
-			prev = curr
+			t = thresh[i]
 
-			d = math.sqrt(dx * dx + dy * dy)
+			# Seek back to the start of the saccade onset
+			marker[i - self.windowOffset:i] = v[i - self.windowOffset:i] >= t
 
-			if dt == 0:
-				dt = 1
+			# Seek forward to the end of the saccade
+			if marker[i]:
+				k = i
+			else:
+				seen = np.flatnonzero(marker[i:written])
+				if len(seen) > 0:
+					k = i + seen[0]
+				else:
+					later = crossings.searchsorted(max(written, i + 1))
+					if later == len(crossings):
+						continue
+					k = crossings[later]
 
-			v = d / float(dt)
+			maxOff = min(k + self.windowSize, n - 1)
+			over = v[k:maxOff] >= t
+			marker[k:maxOff] = over
+			written = max(written, maxOff)
 
-			self.velocities[i] = v
+			if over.all():
+				# The saccade didn't end within the window: stay in it
+				# until the velocity drops below its threshold.
+				resume = firstBelow(v, maxOff, t)
 
-			if v > self.velThresh:
-				self.marker[i] = 1
-			else:
-				self.marker[i] = 0
+		return marker
 
-	def avgVelocity(self, start, end):
-		""" Computes average velocity in a range. """
-		v_1 = []
-		prev = self.window[start]
+	def computeEvents(self, block, marker):
+		""" Builds events from the runs of equal markers. """
+		n = len(block)
+		if n == 0:
+			return EventTable.fromBlock(block, [], [], [], [])
 
-		vsum = 0
-		interval = 0
+		edges = np.flatnonzero(np.diff(marker)) + 1
+		starts = np.concatenate(([0], edges))
+		ends = np.concatenate((edges - 1, [n - 1]))
+		lengths = ends - starts + 1
 
-		for i in range(start + 1, end):
-			curr = self.window[i]
+		types = np.where(marker[starts] == 1, EventTable.SACCADE, EventTable.FIXATION)
 
-			dx = curr.x - prev.x
-			dy = curr.y - prev.y
-			dt = curr.time - prev.time
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
+		xc[types == EventTable.SACCADE] = np.nan
+		yc[types == EventTable.SACCADE] = np.nan
 
-			d = math.sqrt(dx * dx + dy * dy)
+		return EventTable.fromBlock(block, types, starts, ends, lengths, xc, yc)
 
-			prev = curr
+	def hasBlockMode(self):
+		"""processBlock searches without a horizon, so it only stands in
+		   for next() when running offline."""
+		return self.horizon is None
 
-			if dt == 0:
-				dt = 1
+	def processBlock(self, block):
+		v = self.markVelocity(block)
+		marker = self.markSegments(v)
 
-			v = d / float(dt)
+		return self.computeEvents(block, marker)
 
-			vsum += v
-			interval += dt
+	def onlineThreshold(self, i):
+		""" The onset threshold for a crossing at position i, from the
+		    baseline window in the kept velocities. """
+		count = self.windowSize - 1
+		if count <= 0:
+			return 0.0
 
-			v_1.append(v)
-		
-		SD = np.std(np.array(v_1))  # compute standard deviation of velocity in the window
+		start = i - (self.windowSize + self.windowOffset) + 1 - self.base
+		window = self.velocities[start:start + count]
 
-		if interval == 0:
-		  return {'avg':0, 'SD':0}
+		avg = sum(window) / count
+		SD = math.sqrt(sum((w - avg) * (w - avg) for w in window) / count)
 
-		avg = vsum / (end-start-1)   
-		# seems like average velocity is calculated weird before.... 
-		# should either be as wrote here avg = sum(d)/sum(interval), sum(v)/sum(interval) devides interval twice....
-		# return vsum / float(interval)
+		return 3 * SD + avg
 
-		return {'avg': avg, 'SD': SD}
+	def readAhead(self):
+		""" Read samples until the lookahead for the current position is
+		    available, or the input runs out. """
+		need = self.pos + self.horizon + self.windowSize + 1
 
-	def markSegments(self):
-		""" Expands a previously-marked set by computing baselines. """
-		inSaccade = False
+		while not self.exhausted and self.base + len(self.samples) < need:
+			try:
+				curr = self.input.next()
+			except StopIteration:
+				self.exhausted = True
+				break
 
-		for i in range(0, len(self.window)):
-			if not inSaccade and self.velocities[i] > self.velThresh:
-				inSaccade = True
-				baseline = 0.0
-				# Start of a marked segment
-				if i < self.windowSize + self.windowOffset:
-					# We don't have enough samples for a baseline
-					inSaccade = False
-					continue
-				else:
-					averageVelocity = self.avgVelocity(i - (self.windowSize + self.windowOffset), i - self.windowOffset)
-					# baseline = self.avgVelocity(i - (self.windowSize + self.windowOffset), i - self.windowOffset)
+			if len(self.samples) == 0 and self.base == 0:
+				v = 0.0
+			else:
+				prev = self.samples[-1]
+				dt = curr.time - prev.time
+				if dt == 0:
+					dt = 1
+				v = math.hypot(curr.x - prev.x, curr.y - prev.y) / float(dt)
+
+			self.samples.append(curr)
+			self.velocities.append(v)
+			self.marker.append(1 if v > self.velThresh and self.base + len(self.samples) > 1 else 0)
+
+	def markOnline(self, i):
+		""" Handle position i as markSegments() does, if it is a crossing. """
+		b = self.base
+		v = self.velocities
+		marker = self.marker
+
+		if self.resume is not None:
+			# Still in a saccade that outlasted its window?
+			(start, t) = self.resume
+			if i < start or v[i - b] >= t:
+				return
+			self.resume = None
+
+		if not v[i - b] > self.velThresh or i < self.windowSize + self.windowOffset:
+			return
 
-					avg = averageVelocity['avg']
-					SD = averageVelocity['SD']
-				
-				# Seek back to the start of the saccade onset
-				for j in range(i - self.windowOffset, i):
-					if self.velocities[j] >= 3 * SD + avg:
-					# if self.velocities[j] >= 3 * baseline:  baseline was the "incorrect" average velocity, according to the paper, the velocity should exceed mean + 3SD
+		t = self.onlineThreshold(i)
+		n = b + len(v)
 
-						self.marker[j] = 1
+		# Seek back to the start of the saccade onset
+		for j in range(i - self.windowOffset, i):
+			marker[j - b] = 1 if v[j - b] >= t else 0
 
-					else:
-						self.marker[j] = 0
+		# Seek forward to the end of the saccade, within the horizon
+		k = i
+		while k < min(i + self.horizon, n) and marker[k - b] == 0:
+			k += 1
+		if k >= min(i + self.horizon, n):
+			return
 
-				# Seek forward to the end of the saccade
-				k = i
-				while self.marker[k] == 0:
-					k += 1
-				maxOff = k + self.windowSize
-				if maxOff > len(self.window) - 1:
-					maxOff = len(self.window) - 1
-				for l in range(k, maxOff):
-					if self.velocities[l] >= 3 * SD +avg:
-						self.marker[l] = 1
-					else:
-						self.marker[l] = 0
-						inSaccade = False
+		maxOff = k + self.windowSize
+		if self.exhausted and maxOff > n - 1:
+			maxOff = n - 1
+		over = True
+		for l in range(k, maxOff):
+			if v[l - b] >= t:
+				marker[l - b] = 1
 			else:
-				continue
+				marker[l - b] = 0
+				over = False
 
+		if over:
+			self.resume = (maxOff, t)
 
-	def computeEvents(self):
-		inSaccade = False
-		event = []
-		for i in range(0, len(self.window)):
-			if not inSaccade and self.marker[i] == 0:
-				event.append(self.window[i])
-				continue
-			if inSaccade and self.marker[i] == 1:
-				event.append(self.window[i])
-				continue
-			if inSaccade and self.marker[i] == 0:
-				inSaccade = False
-				if len(event) > 0:
-					e = ESaccade(len(event), event[0], event[-1])
-					self.events.append(e)
-				event = [self.window[i]]
-				continue
-			if not inSaccade and self.marker[i] == 1:
-				inSaccade = True
-				if len(event) > 0:
-					c = self.centroid(event)
-					e = EFixation(c,len(event),event[0],event[-1])
-					self.events.append(e)
-				event = [self.window[i]]
-				continue
-		# Whatever is left over
-		if not inSaccade and len(event) > 0:
-			c = self.centroid(event)
-			e = EFixation(c,len(event),event[0],event[-1])
-			self.events.append(e)
-			return
-		if inSaccade and len(event) > 0:
-			e = ESaccade(len(event),event[0],event[-1])
-			self.events.append(e)
-			return
+	def addToEvent(self, i):
+		""" Add the sample at position i, whose marker is final, to the
+		    current event, closing the event first if the marker changed. """
+		samp = self.samples[i - self.base]
+		kind = self.marker[i - self.base]
 
+		if self.event is not None and self.event[0] != kind:
+			self.closeEvent()
 
-	def next(self):
-		if self.exhausted:
-			raise StopIteration
-
-		if len(self.events) == 0:
-			# We haven't computed events yet
-			self.fillWindow()
-			self.markVelocity()
-			self.markSegments()
-			self.computeEvents()
-			if len(self.events) == 0:
-				self.exhausted = True
-				raise StopIteration
-			else:
-				e = self.events[0]
-				self.events = self.events[1:]
-				return e
+		if self.event is None:
+			self.event = [kind, samp, samp, 1, samp.x, samp.y]
 		else:
-			e = self.events[0]
-			if len(self.events) == 1:
-				self.exhausted = True
-				return e
+			e = self.event
+			e[2] = samp
+			e[3] += 1
+			e[4] = e[4] + samp.x
+			e[5] = e[5] + samp.y
+
+	def closeEvent(self):
+		(kind, first, last, length, xs, ys) = self.event
+		self.event = None
+
+		if kind == 1:
+			self.events.append(ESaccade(length, first, last))
+		else:
+			# As centroid() does, move the first sample to the centroid.
+			first.x = round(xs / float(length))
+			first.y = round(ys / float(length))
+			self.events.append(EFixation(first, length, first, last))
+
+	def nextOnline(self):
+		while len(self.events) == 0:
+			self.readAhead()
+			n = self.base + len(self.samples)
+
+			if self.pos >= n:
+				# End of input: everything is final.
+				while self.done < n:
+					self.addToEvent(self.done)
+					self.done += 1
+				if self.event is None:
+					raise StopIteration
+				self.closeEvent()
+				break
+
+			self.markOnline(self.pos)
+			self.pos += 1
+
+			# Later crossings only reach windowOffset samples back.
+			while self.done < self.pos - self.windowOffset:
+				self.addToEvent(self.done)
+				self.done += 1
+
+			# Drop samples no longer needed for baselines or events.
+			keep = min(self.done, self.pos - (self.windowSize + self.windowOffset))
+			if keep - self.base > 1024:
+				cut = keep - self.base
+				del self.samples[:cut]
+				del self.velocities[:cut]
+				del self.marker[:cut]
+				self.base = keep
+
+		return self.events.popleft()
 
-			self.events = self.events[1:]
-			return e
+	def next(self):
+		if self.horizon is not None:
+			return self.nextOnline()
+
+		# Events are computed in a single pass over the whole input, the
+		# first time they are asked for.
+		if self.output is None:
+			try:
+				block = readBlock(self.input)
+			except StopIteration:
+				self.output = iter([])
+			else:
+				self.output = iter(self.processBlock(block))
 
+		return self.output.next()
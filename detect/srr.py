@@ -24,7 +24,10 @@ from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
 from eventstream import ESaccade
+from eventstream import EventTable
+import collections
 import math
+import numpy as np
 
 class SRR(EventStream):
 	"""A velocity and acceleration threshold-based algorithm,
@@ -41,6 +44,9 @@ class SRR(EventStream):
 	   Use one of the other filter modules to provide custom filtering behaviour 
 	   prior to applying this event detector.
 
+	   The window keeps a running sum of its inter-sample distances, so
+	   the cost per sample does not depend on windowSize.
+
 	   Parameters:
 		windowSize: the size of the window (in samples).
 		velThresh (pixels/s) The velocity above which to detect a saccade.
@@ -53,7 +59,9 @@ class SRR(EventStream):
 		self.windowSize = windowSize
 		self.velThresh = velThresh
 		self.accelThresh = accelThresh
-		self.window = []
+		self.window = collections.deque()
+		self.distances = collections.deque() # Between consecutive window samples
+		self.dsum = 0.0
 		self.prevVelocity = 0.0
 		self.prevTime = 0
 		self.onsetDelay = onsetDelay
@@ -64,37 +72,41 @@ class SRR(EventStream):
 	def fillWindow(self):
 		try:
 			while len(self.window) < self.windowSize:
-				self.window.append(self.input.next())
+				curr = self.input.next()
+				if len(self.window) > 0:
+					prev = self.window[-1]
+					dx = curr.x - prev.x
+					dy = curr.y - prev.y
+					d = math.sqrt(dx * dx + dy * dy)
+					self.distances.append(d)
+					self.dsum = self.dsum + d
+				self.window.append(curr)
 		except StopIteration:
 			return
 
+	def dropSample(self):
+		""" Remove the first sample from the window. """
+		self.window.popleft()
+		if len(self.distances) > 0:
+			self.dsum = self.dsum - self.distances.popleft()
+		if len(self.window) <= 1:
+			# Start the next window's sum afresh.
+			self.dsum = 0.0
+
 	def windowVelocity(self):
 		""" Compute average inter-sample velocity over a window of samples. """
-		prev = self.window[0]
-
-		dsum = 0
-		interval = 0
-
-		for curr in self.window[1:]:
-
-			dx = curr.x - prev.x
-			dy = curr.y - prev.y
-			dt = curr.time - prev.time
-
-			dsum = dsum + math.sqrt(dx * dx + dy * dy)
-			interval = interval + dt
+		interval = self.window[-1].time - self.window[0].time
 
 		if interval == 0:
 			interval = 1
 
-		return dsum / float(interval)
+		return self.dsum / float(interval)
 
-	def windowAccel(self):
+	def windowAccel(self, currVelocity):
 		""" Compute instantaneous acceleration over a window of samples. """
 		# We use the self.prevVelocity
 
 		currTime = self.window[0].time 
-		currVelocity = self.windowVelocity()
 		dt = currTime - self.prevTime
 		dv = currVelocity - self.prevVelocity
 
@@ -126,8 +138,8 @@ class SRR(EventStream):
 						self.event = []
 						return e
 			
-			ac = self.windowAccel()
 			vc = self.windowVelocity()
+			ac = self.windowAccel(vc)
 
 			if self.inSaccade:
 				# Currently in a saccade. Have we dropped below the thresholds?
@@ -140,7 +152,7 @@ class SRR(EventStream):
 					self.onsetCount += 1
 				self.event.append(self.window[0])
 			
-			self.window = self.window[1:]
+			self.dropSample()
 
 			if self.onsetCount >= self.onsetDelay:
 				self.onsetCount = 0
@@ -156,8 +168,78 @@ class SRR(EventStream):
 					self.event = []
 					return e
 
-
-
-
-		
-
+	def blockKinematics(self, block):
+		""" Compute the window velocity and acceleration at every sample of
+		    a block, as next() does, using cumulative sums of the
+		    inter-sample distances.  Returns arrays (velocity, accel). """
+		n = len(block)
+		x = np.asarray(block.x, dtype=float)
+		y = np.asarray(block.y, dtype=float)
+		t = np.asarray(block.time)
+
+		cd = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+
+		# Windows run to the end of the block, shrinking as they reach it.
+		first = np.arange(n)
+		last = np.minimum(first + self.windowSize, n) - 1
+
+		interval = (t[last] - t[first]).astype(float)
+		interval[interval == 0] = 1
+		velocity = (cd[last] - cd[first]) / interval
+
+		dt = (t - np.concatenate(([0], t[:-1]))).astype(float)
+		dt[dt == 0] = 1
+		accel = (velocity - np.concatenate(([0.0], velocity[:-1]))) / dt
+
+		return (velocity, accel)
+
+	def processBlock(self, block):
+		""" Run SRR over a whole block, giving the same events as next().
+
+		    The onset count only advances on samples that meet the
+		    condition for the current state, so each event ends where
+		    the running count of those samples reaches onsetDelay. """
+		n = len(block)
+		(velocity, accel) = self.blockKinematics(block)
+
+		# Running counts of samples that would advance the onset count
+		# in fixation and in saccade states.
+		counts = (
+			np.concatenate(([0], np.cumsum((accel > self.accelThresh) & (velocity > self.velThresh)))),
+			np.concatenate(([0], np.cumsum((accel < self.accelThresh) | (velocity < self.velThresh)))),
+		)
+
+		delay = max(self.onsetDelay, 1)
+		types = []
+		starts = []
+		ends = []
+
+		p = 0
+		inSaccade = False
+		while p < n:
+			c = counts[inSaccade]
+			e = c.searchsorted(c[p] + delay) - 1
+
+			if self.onsetDelay <= 0:
+				e = p
+			elif e >= n:
+				e = n - 1
+
+			types.append(EventTable.SACCADE if inSaccade else EventTable.FIXATION)
+			starts.append(p)
+			ends.append(e)
+
+			inSaccade = not inSaccade
+			p = e + 1
+
+		types = np.array(types, dtype=np.int8)
+		starts = np.array(starts, dtype=np.intp)
+		ends = np.array(ends, dtype=np.intp)
+		lengths = ends - starts + 1
+
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
+		fix = types == EventTable.FIXATION
+		xc[~fix] = np.nan
+		yc[~fix] = np.nan
+
+		return EventTable.fromBlock(block, types, starts, ends, lengths, xc, yc)
@@ -0,0 +1,151 @@
+###############################################################################
+# Event Detection Algorithm Suite
+#  Copyright (C) 2012 Gian Perrone (http://github.com/gian)
+#  
+#  Permission to use, copy, modify, and distribute this software and its
+#  documentation for any purpose and without fee is hereby granted,
+#  provided that the above copyright notice appear in all copies and that
+#  both the copyright notice and this permission notice and warranty
+#  disclaimer appear in supporting documentation, and that the name of
+#  the above copyright holders, or their entities, not be used in
+#  advertising or publicity pertaining to distribution of the software
+#  without specific, written prior permission.
+#  
+#  The above copyright holders disclaim all warranties with regard to
+#  this software, including all implied warranties of merchantability and
+#  fitness. In no event shall the above copyright holders be liable for
+#  any special, indirect or consequential damages or any damages
+#  whatsoever resulting from loss of use, data or profits, whether in an
+#  action of contract, negligence or other tortious action, arising out
+#  of or in connection with the use or performance of this software.
+###############################################################################
+
+from . import sample
+from sample import SampleBlock
+from . import eventstream
+from eventstream import EventTable
+
+import math
+import numpy as np
+
+# Labels in the eventType column, as in labelled recordings.
+FIXATION = EventTable.FIXATION
+SACCADE = EventTable.SACCADE
+BLINK = 3
+
+def fold(p, low, high):
+	"""Reflect positions back into [low, high], as if bouncing off the
+	   edges of the screen."""
+	span = float(high - low)
+	return low + span - np.abs(np.mod(p - low, 2 * span) - span)
+
+def synthesize(n, rate=500.0, seed=None, timeScale=1000000.0, screen=(1024, 768),
+               pixelsPerDegree=35.0, fixationDuration=0.25, saccadeAmplitude=6.0,
+               drift=0.05, tremor=0.3, blinkRate=0.05):
+	"""Generate a labelled recording of n samples as a SampleBlock.
+
+	   The recording alternates fixations and saccades.  Fixation durations
+	   are gamma distributed around 'fixationDuration' (s), and the gaze
+	   wanders from the fixation target by a random walk of 'drift'
+	   pixels per sample.  Saccade amplitudes are gamma distributed around
+	   'saccadeAmplitude' (degrees), in random directions, kept on the
+	   screen by reflecting off its edges.  Saccade durations follow the
+	   main sequence (21 ms + 2.2 ms/degree), with a smooth bell-shaped
+	   velocity profile.  Gaussian tremor of 'tremor' pixels is added to
+	   every sample.  A fraction 'blinkRate' of fixations contain a blink
+	   of 100-300 ms, recorded as (0,0), as trackers do.
+
+	   Timestamps count 1/timeScale seconds (microseconds by default, as
+	   in recording files) at 'rate' Hz.  The 'eventType' column holds
+	   FIXATION, SACCADE or BLINK.  The same seed gives the same recording.
+
+	   Everything is generated with array operations, so millions of
+	   samples take a second or so.
+	"""
+	rs = np.random.RandomState(seed)
+	(width, height) = screen
+
+	if n <= 0:
+		return SampleBlock(np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.int64),
+		                   np.zeros(0), np.zeros(0), eventType=np.zeros(0, dtype=np.int8))
+
+	# Draw enough fixation/saccade pairs to cover n samples.
+	meanPair = rate * (fixationDuration + 0.021 + 0.0022 * saccadeAmplitude)
+	m = int(n / meanPair * 1.2) + 2
+	while True:
+		fixLen = np.maximum(np.round(rs.gamma(3.0, fixationDuration / 3.0, m) * rate), 2).astype(np.intp)
+		amp = rs.gamma(2.0, saccadeAmplitude / 2.0, m)
+		theta = rs.uniform(0, 2 * math.pi, m)
+		if fixLen.sum() + m * 2 >= n or m * meanPair > 4 * n:
+			break
+		m = m * 2
+
+	# Fixation targets: saccade displacements, reflected at the edges.
+	tx = np.concatenate(([rs.uniform(0, width)], amp * pixelsPerDegree * np.cos(theta)))
+	ty = np.concatenate(([rs.uniform(0, height)], amp * pixelsPerDegree * np.sin(theta)))
+	tx = fold(np.cumsum(tx), 0, width)
+	ty = fold(np.cumsum(ty), 0, height)
+
+	# Saccade k runs from fixation k to fixation k + 1; its duration comes
+	# from the amplitude left after any reflection.
+	amp = np.hypot(np.diff(tx), np.diff(ty)) / pixelsPerDegree
+	sacLen = np.maximum(np.round((0.021 + 0.0022 * amp) * rate), 2).astype(np.intp)
+
+	# Events alternate: fixation 0, saccade 0, fixation 1, ...
+	lengths = np.empty(2 * m, dtype=np.intp)
+	lengths[0::2] = fixLen
+	lengths[1::2] = sacLen
+	starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+	event = np.repeat(np.arange(2 * m), lengths)[:n]
+	phase = np.arange(len(event)) - starts[event]
+	k = event // 2
+	saccadic = (event % 2) == 1
+	n = len(event)
+
+	x = np.empty(n)
+	y = np.empty(n)
+
+	# Fixations: the target plus drift, restarted at each fixation.
+	fixStarts = starts[0::2]
+	fixEnds = np.minimum(fixStarts + fixLen, n) - 1
+	driftEnd = []
+	for (pos, target) in ((x, tx), (y, ty)):
+		walk = np.cumsum(rs.normal(0, drift, n))
+		offset = walk - walk[np.minimum(fixStarts, n - 1)][k]
+		pos[:] = target[k] + offset
+		driftEnd.append(offset[np.maximum(fixEnds, 0)])
+
+	# Saccades: from where the fixation drifted to, to the next target,
+	# along a path whose speed rises and falls smoothly.
+	s = np.flatnonzero(saccadic)
+	ks = k[s]
+	u = (phase[s] + 1) / sacLen[ks].astype(float)
+	shape = u - np.sin(2 * math.pi * u) / (2 * math.pi)
+	for (pos, target, end) in ((x, tx, driftEnd[0]), (y, ty, driftEnd[1])):
+		origin = target[ks] + end[ks]
+		pos[s] = origin + (target[ks + 1] - origin) * shape
+
+	x += rs.normal(0, tremor, n)
+	y += rs.normal(0, tremor, n)
+
+	labels = np.where(saccadic, SACCADE, FIXATION).astype(np.int8)
+
+	# Blinks, in the middle of some fixations.
+	blinky = rs.random_sample(m) < blinkRate
+	blinkLen = np.minimum(np.round(rs.uniform(0.1, 0.3, m) * rate).astype(np.intp), fixLen - 2)
+	blinkStart = (fixLen - blinkLen) // 2
+	f = np.flatnonzero(~saccadic)
+	kf = k[f]
+	closed = f[blinky[kf] & (phase[f] >= blinkStart[kf]) & (phase[f] < blinkStart[kf] + blinkLen[kf])]
+	x[closed] = 0
+	y[closed] = 0
+	labels[closed] = BLINK
+
+	interval = timeScale / float(rate)
+	if interval.is_integer():
+		time = np.arange(n, dtype=np.int64) * int(interval)
+	else:
+		time = np.arange(n) * interval
+
+	return SampleBlock(np.arange(n), time, x, y, eventType=labels)
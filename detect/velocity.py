@@ -23,6 +23,8 @@
 from . import eventstream
 from eventstream import EventStream
 from eventstream import EFixation
+from eventstream import EventTable
+from eventstream import findRuns
 
 import math
 
@@ -45,7 +47,7 @@ class Velocity(EventStream):
 	def __init__(self, sampleStream, threshold):
 		super(Velocity, self).__init__(sampleStream)
 		self.threshold = threshold
-		self.prev = self.input.next()
+		self.prev = None
 
 	def intersampleVelocity(self,prev,curr):
 		dx = curr.x - prev.x
@@ -63,6 +65,9 @@ class Velocity(EventStream):
 		
 
 	def next(self):
+		if self.prev is None:
+			self.prev = self.input.next()
+
 		fixation = []
 
 		for curr in self.input:
@@ -92,3 +97,23 @@ class Velocity(EventStream):
 			c = self.centroid(fixation)
 			return EFixation(c,len(fixation),fixation[0],fixation.pop())
 
+	def processBlock(self, block):
+		""" Batch I-VT over a block with a 'velocity' column, giving the
+		    same fixations as next().
+
+		    A sample joins a fixation when the velocity of the sample after
+		    it is under the threshold, so fixations are the runs of
+		    sub-threshold velocities, shifted back by one sample. """
+		below = block.velocity[1:] < self.threshold
+
+		(starts, lengths) = findRuns(below)
+
+		# A fixation ends at the sample whose successor broke the run, or
+		# at its own last sample if the input ran out first.
+		ends = starts + lengths
+		ends[ends == len(below)] -= 1
+
+		(xc, yc) = self.blockCentroids(block, starts, lengths)
+
+		return EventTable.fromBlock(block, EventTable.FIXATION, starts, ends, lengths, xc, yc)
+
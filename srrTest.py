@@ -20,16 +20,12 @@
 #  of or in connection with the use or performance of this software.
 ###############################################################################
 
-from detect.sample import Sample
 from detect.sample import FileSampleStream
+from detect.sample import readSampleFile
 
-from detect.dispersion import *
-from detect.velocity import *
-from detect.hmm import *
-from detect.aoi import *
-from detect.movingaverage import *
 from detect.srr import *
 from detect.blinkfilter import *
+from detect.evaluate import *
 
 print "============= SRR test ==============="
 
@@ -37,95 +33,14 @@ stream = FileSampleStream('testData/UH27_img_vy_labelled_MN.txt')
 
 bstream = BlinkFilter(stream)
 
-d = SRR(bstream, 9, 0.0001, 0.00000001)
+d = SRR(bstream, 9, 0.0001, 0.00000001, 2)
 
-fixations = []
+events = []
 
 for i in d: 
 	print i
-	fixations.append(i)
-
-verifStream = BlinkFilter(FileSampleStream('testData/UH27_img_vy_labelled_MN.txt'))
-
-taggedEvents = []
-cfix = []
-eventType = []
-for i in verifStream:
-	if i.eventType == 1:
-		cfix.append(i)
-		eventType.append(1)
-	else:
-		eventType.append(0)
-		if len(cfix) == 0:
-			continue
-		print ("Fixation of length: " + str(len(cfix)) + " starting at sample " + str(cfix[0].index))
-		p = d.centroid(cfix)
-
-		f = EFixation(p, len(cfix), cfix[0], cfix[-1])
-		taggedEvents.append(f)
-		cfix = []
-
-verifStream = FileSampleStream('testData/UH27_img_vy_labelled_MN.txt')
-
-saccEvents = []
-csacc = []
-saccEventType = []
-for i in verifStream:
-	if i.eventType == 2:
-		csacc.append(i)
-		saccEventType.append(1)
-	else:
-		saccEventType.append(0)
-		if len(csacc) == 0:
-			continue
-		print ("Saccade of length: " + str(len(csacc)) + " starting at sample " + str(csacc[0].index))
-
-		f = ESaccade(len(csacc), csacc[0], csacc[-1])
-		saccEvents.append(f)
-		csacc = []
-
-
-matchedSamples = 0
-errorSamples = 0
-fixCount = 0
-for f in fixations:
-	if f.type != 'fixation':
-		continue
-	s = f.start.index
-	for i in range(s,s+f.length):
-		fixCount = fixCount + 1
-		if eventType[i] == 1:
-			matchedSamples = matchedSamples + 1
-		else:
-			errorSamples = errorSamples + 1
-
-mPct = matchedSamples / float(fixCount)
-ePct = errorSamples / float(fixCount)
-
-print "Fixations:"
-print "Matched Samples: " + str(matchedSamples) + " (" + str(mPct * 100) + "%)"
-print "Error Samples: " + str(errorSamples) + " (" + str(ePct * 100) + "%)"
-
-matchedSamples = 0
-errorSamples = 0
-saccCount = 0
-
-for f in fixations:
-	if f.type != 'saccade':
-		continue
-	s = f.start.index
-	for i in range(s,s+f.length):
-		if saccEventType[i] == 1:
-			saccCount = saccCount + 1
-			matchedSamples = matchedSamples + 1
-		else:
-			errorSamples = errorSamples + 1
-
-mPct = matchedSamples / float(saccCount)
-ePct = errorSamples / float(saccCount)
-print "Saccades:"
-print "Matched Samples: " + str(matchedSamples) + " (" + str(mPct * 100) + "%)"
-print "Error Samples: " + str(errorSamples) + " (" + str(ePct * 100) + "%)"
-
+	events.append(i)
 
+truth = BlinkFilter(None).processBlock(readSampleFile('testData/UH27_img_vy_labelled_MN.txt'))
 
+print evaluate(events, truth)
@@ -33,6 +33,12 @@ from detect.intersamplevelocity import *
 from detect.engbertkliegl import *
 from detect.noisefilter import *
 from detect.smeetshooge import *
+from detect.blinkfilter import *
+from detect.sgfilter import *
+from detect.pipeline import *
+from detect.synth import synthesize
+
+import random
 
 def lineto (x1,y1,x2,y2,offset,samples,timeInterval):
 	l = []
@@ -169,6 +175,23 @@ h2 = HMM(stream, 0.01, 100.0, 4500.0, 100.0, 0.95, 0.05, 0.95, 0.05)
 for i in h2:
 	print i
 
+print " * Test 3: fixations start at their centroid"
+
+recording = synthesize(5000, seed=9, timeScale=1.0)
+samples = list(BlinkFilter(ListSampleStream(list(recording.samples()))))
+position = dict((s.index, k) for (k, s) in enumerate(samples))
+
+h3 = HMM(ListSampleStream(samples), 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1)
+same = True
+
+for e in h3:
+	if e.type == 'fixation':
+		k = position[e.start.index]
+		c = h3.centroid([s.copy() for s in samples[k:k + e.length]])
+		same = same and (e.start.x, e.start.y) == (c.x, c.y)
+
+print same
+
 #print "============= Prefix test ==============="
 #testPathB = fixate(500,500,0,3,0.001)
 #testPathB.extend(saccto(500,500,400,400,4,4,0.001))
@@ -258,5 +281,384 @@ h = SmeetsHooge(stream, 10000, 3, 3)
 for i in h:
 	print i
 
+print "============= Pipeline test ============"
+
+# Every stage, run as a bare per-sample chain and through Pipeline.fromChain,
+# which fuses the chain into block mode where that gives the same output.
+# Times are in seconds, so velocities are in pixels/s.
+
+recording = synthesize(10000, seed=7, timeScale=1.0)
+clean = BlinkFilter(None).processBlock(recording)
+sigma = tuple(medianSigma(np.column_stack(fivePointVelocity(clean))))
+areas = [(x, y, x + 127, y + 127) for x in range(0, 1024, 128) for y in range(0, 768, 128)]
+
+def velocities(s):
+	return IntersampleVelocity(BlinkFilter(s))
+
+chains = [
+	('BlinkFilter', lambda s: BlinkFilter(s)),
+	('MovingAverageFilter', lambda s: MovingAverageFilter(s, 9)),
+	('NoiseFilter', lambda s: NoiseFilter(s, 1.0)),
+	('IntersampleVelocity', lambda s: IntersampleVelocity(s)),
+	('SGFilter', lambda s: SGFilter(velocities(s), 9, 2)),
+	('Velocity', lambda s: Velocity(velocities(s), 1050.0)),
+	('Dispersion', lambda s: Dispersion(BlinkFilter(s), 25, 35.0)),
+	('HMM', lambda s: HMM(velocities(s), 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1)),
+	('HMM (lag)', lambda s: HMM(velocities(s), 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1, lag=50)),
+	('AOI', lambda s: AOI(BlinkFilter(s), 25, areas)),
+	('SRR', lambda s: SRR(BlinkFilter(s), 3, 1050.0, 280000.0, 2)),
+	('EngbertKliegl', lambda s: EngbertKliegl(BlinkFilter(s), 6)),
+	('EngbertKliegl (sigma)', lambda s: EngbertKliegl(BlinkFilter(s), 6, sigma=sigma)),
+	('SmeetsHooge', lambda s: SmeetsHooge(velocities(s), 1050.0, 20, 5)),
+	('SmeetsHooge (horizon)', lambda s: SmeetsHooge(velocities(s), 1050.0, 20, 5, horizon=200)),
+]
+
+def outline(o):
+	if isinstance(o, Sample):
+		v = o.velocity
+		return (o.index, round(o.x, 6), round(o.y, 6), v if v is None else round(v, 6))
+	return (o.type, o.start.index, o.end.index, o.length, round(o.start.x, 6), round(o.start.y, 6))
+
+for (name, chain) in chains:
+	random.seed(1)
+	bare = [outline(o) for o in chain(ListSampleStream(list(recording.samples())))]
+
+	random.seed(1)
+	p = Pipeline.fromChain(chain(ListSampleStream(recording)))
+	fused = [outline(o) for o in p]
+
+	print " * %s: %d out, fused: %s, same: %s" % (name, len(bare), p.hasBlockMode(), bare == fused)
+
+# Short input, which MovingAverageFilter shrinks to nothing before it
+# reaches SGFilter, and input too short for SGFilter's window, which
+# raises either way.
+
+def outlines(stream):
+	try:
+		return [outline(o) for o in stream]
+	except TypeError as e:
+		return str(e)
+
+chain = lambda s: SGFilter(IntersampleVelocity(MovingAverageFilter(s, 9)), 9, 2)
+
+for n in (0, 5, 12, 14):
+	short = synthesize(n, seed=7, timeScale=1.0)
+	bare = outlines(chain(ListSampleStream(list(short.samples()))))
+	fused = outlines(Pipeline.fromChain(chain(ListSampleStream(short))))
+	print " * %d samples: %s, same: %s" % (n, bare if isinstance(bare, str) else "%d out" % len(bare), bare == fused)
+
+print "============= Sample file test ============"
+
+import os
+import tempfile
+from detect.sample import FileSampleStream, readSampleFile
+
+directory = tempfile.mkdtemp()
+text = os.path.join(directory, 'recording.txt')
+
+def writeSampleFile(filename, block, extra=0):
+	rows = np.column_stack([block.time, np.round(block.x), np.round(block.y), block.eventType] + [block.index] * extra)
+	handle = open(filename, 'w')
+	handle.write("\t".join(['time', 'x', 'y', 'eventType'] + ['extra'] * extra) + "\n")
+	for r in rows.astype(np.int64):
+		handle.write("\t".join(str(v) for v in r) + "\n")
+	handle.close()
+	return rows
+
+recording = synthesize(3000, seed=13)
+rows = writeSampleFile(text, recording)
+
+loaded = readSampleFile(text)
+print " * text: %d samples, first index %d, same: %s" % (len(loaded), loaded.index[0],
+	all((loaded.columns[n] == rows[:,i]).all() for (i, n) in enumerate(FileSampleStream.fileColumns)))
+
+def fields(s):
+	return (s.index, s.time, s.x, s.y, s.eventType)
+
+streamed = [fields(s) for s in FileSampleStream(text, chunkSize=1000)]
+print " * FileSampleStream: same: %s" % (streamed == [fields(s) for s in loaded.samples()])
+
+# Further columns are ignored, as long as every row has them.
+writeSampleFile(text, recording, extra=1)
+print " * extra column: same: %s" % (streamed == [fields(s) for s in FileSampleStream(text, chunkSize=1000)])
+
+handle = open(text, 'a')
+handle.write("1\t2\t3\t4\n")
+handle.close()
+try:
+	readSampleFile(text)
+except ValueError as e:
+	print " * short row:", e
+
+os.remove(text)
+os.rmdir(directory)
+
+print "============= Binary recording test ============"
+
+from detect.recording import *
+
+directory = tempfile.mkdtemp()
+text = os.path.join(directory, 'recording.txt')
+binary = os.path.join(directory, 'recording.rec')
+
+writeSampleFile(text, synthesize(3000, seed=13))
+loaded = readSampleFile(text)
+
+def sameColumns(a, b):
+	return sorted(a.columns) == sorted(b.columns) and all((a.columns[n] == b.columns[n]).all() for n in a.columns)
+
+convertRecording(text, binary)
+mapped = MappedSampleStream(binary)
+(dtype, count, rate) = readHeader(binary)
+print " * converted: %d samples at %.1f Hz, same: %s" % (count, mapped.rate,
+	sameColumns(mapped.block, loaded) and sameColumns(mapRecording(binary), loaded))
+print " * MappedSampleStream: same: %s" % ([fields(s) for s in mapped] == [fields(s) for s in loaded.samples()])
+
+writeRecording(binary, [loaded[:1000], loaded[1000:]], 250.0)
+print " * written in blocks: %.1f Hz, same: %s" % (readHeader(binary)[2], sameColumns(mapRecording(binary), loaded))
+
+os.remove(text)
+os.remove(binary)
+os.rmdir(directory)
+
+print "============= Time index test ============"
+
+# Times out of order as well as in order; windows are t0 <= time < t1.
+
+from detect.sample import TimeIndex
+
+recording = synthesize(3000, seed=13)
+(t0, t1) = (recording.time[100], recording.time[200])
+
+stream = ListSampleStream(recording)
+window = [s.index for s in stream.sliceTime(t0, t1)]
+stream.seekTime(t0 + 1)
+print " * sliceTime: %d samples from %d, seekTime: %d" % (len(window), window[0], stream.next().index)
+print " * list stream: same: %s" % (window == [s.index for s in ListSampleStream(list(recording.samples())).sliceTime(t0, t1)])
+
+shuffled = recording.select(np.random.RandomState(13).permutation(len(recording)))
+index = TimeIndex(shuffled.time)
+picked = shuffled.sliceTime(t0, t1)
+print " * shuffled: ordered: %s, same: %s" % (index.isOrdered(), sorted(picked.index) == window and
+	list(picked.index) == [i for i in shuffled.index if recording.index[100] <= i < recording.index[200]])
+
+print "============= I-DT block mode test ============"
+
+# processBlock() against next(), on a synthetic recording with fractional
+# positions and again with whole pixels (as in recording files).  Times
+# are in seconds, so velocities are in pixels/s.
+
+def perSample(stage, block):
+	return [outline(o) for o in stage(ListSampleStream(list(block.samples())))]
+
+def blockMode(stage, block):
+	return [outline(o) for o in stage(None).processBlock(block)]
+
+recording = synthesize(8000, seed=11, timeScale=1.0)
+clean = BlinkFilter(None).processBlock(recording)
+whole = clean.withColumns(x=np.round(clean.x), y=np.round(clean.y))
+blocks = [IntersampleVelocity(None).processBlock(b) for b in (clean, whole)]
 
+def compareModes(settings):
+	counts = [len(perSample(stage, blocks[0])) for stage in settings]
+	same = all(perSample(stage, b) == blockMode(stage, b) for stage in settings for b in blocks)
+	print " * %s events, same: %s" % (counts, same)
+
+compareModes([lambda s: Dispersion(s, 25, 35.0), lambda s: Dispersion(s, 10, 15.0)])
+
+print "============= I-VT block mode test ============"
+
+compareModes([lambda s: Velocity(s, 1050.0), lambda s: Velocity(s, 3000.0)])
+
+print "============= I-HMM block mode test ============"
+
+compareModes([lambda s: HMM(s, 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1),
+              lambda s: HMM(s, 500.0, 400.0, 3000.0, 2000.0, 0.8, 0.2, 0.7, 0.3)])
+
+print "============= I-HMM online test ============"
+
+# With a lag past the point where the Viterbi paths merge, the online
+# decoder gives the offline events.
+
+offline = perSample(lambda s: HMM(s, 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1), blocks[0])
+
+for lag in (50, 1000):
+	online = perSample(lambda s: HMM(s, 250.0, 150.0, 4500.0, 3000.0, 0.95, 0.05, 0.9, 0.1, lag=lag), blocks[0])
+	print " * lag %d: %d events, same: %s" % (lag, len(online), online == offline)
+
+print "============= I-HMM training test ============"
+
+# Velocities from a two-state chain with known parameters.
+
+rs = np.random.RandomState(19)
+n = 20000
+states = np.zeros(n, dtype=int)
+switch = rs.uniform(size=n)
+for k in range(1, n):
+	states[k] = 1 - states[k - 1] if switch[k] < (0.02, 0.2)[states[k - 1]] else states[k - 1]
+v = np.where(states == 0, rs.normal(300.0, 100.0, n), rs.normal(5000.0, 1500.0, n))
+
+params = trainHMM(v)
+print " * trained: %s" % ", ".join("%.2f" % p for p in params)
+print " * close: %s" % np.allclose(params, (300.0, 100.0, 5000.0, 1500.0, 0.98, 0.02, 0.8, 0.2), rtol=0.1, atol=0.02)
+print " * tuple of recordings: same: %s" % (trainHMM((v[:n // 2], v[n // 2:])) == trainHMM([v[:n // 2], v[n // 2:]]))
+
+print "============= SRR block mode test ============"
+
+compareModes([lambda s: SRR(s, 3, 1050.0, 280000.0, 2), lambda s: SRR(s, 9, 3000.0, 500000.0, 4)])
+
+print "============= RunningMedian test ============"
+
+# Against np.median over the same window; rounding gives plenty of ties.
+
+values = np.random.RandomState(15).normal(size=1500).round(1)
+
+for size in (None, 1, 2, 7, 100):
+	m = RunningMedian(size)
+	same = True
+	for (k, v) in enumerate(values):
+		m.push(v)
+		window = values[0 if size is None else max(0, k + 1 - size):k + 1]
+		same = same and len(m) == len(window) and m.median() == np.median(window)
+	print " * window %s: same: %s" % (size, same)
+
+print "============= EngbertKliegl block mode test ============"
+
+sigma = tuple(medianSigma(np.column_stack(fivePointVelocity(clean))))
+compareModes([lambda s: EngbertKliegl(s, 6, sigma=sigma), lambda s: EngbertKliegl(s, 4, minDuration=2, sigma=sigma)])
+
+print "============= SmeetsHooge block mode test ============"
+
+compareModes([lambda s: SmeetsHooge(s, 1050.0, 20, 5), lambda s: SmeetsHooge(s, 3000.0, 8, 2)])
+
+print "============= SmeetsHooge online test ============"
+
+# With a horizon past every search, the online detector gives the offline
+# events, on synthetic data and on the test path above.
+
+offline = perSample(lambda s: SmeetsHooge(s, 1050.0, 20, 5), blocks[0])
+online = perSample(lambda s: SmeetsHooge(s, 1050.0, 20, 5, horizon=10000), blocks[0])
+print " * horizon 10000: %d events, same: %s" % (len(online), online == offline)
+
+testPathB = fixate(500,500,0,10,0.001)
+testPathB.extend(saccto(500,500,400,400,11,5,0.001))
+testPathB.extend(fixate(400,400,17,8,0.001))
+testPathB.extend(saccto(400,400,300,300,26,10,0.001))
 
+def smoothed():
+	return MovingAverageFilter(ListSampleStream([s.copy() for s in testPathB]), 2)
+
+offline = [outline(e) for e in SmeetsHooge(smoothed(), 10000, 3, 3)]
+online = [outline(e) for e in SmeetsHooge(smoothed(), 10000, 3, 3, horizon=20)]
+print " * test path, horizon 20: %d events, same: %s" % (len(online), online == offline)
+
+print "============= AOI index test ============"
+
+# AreaIndex against a linear scan over the areas, first match winning.
+
+rs = np.random.RandomState(19)
+
+def inside(area, x, y):
+	if isinstance(area, Polygon):
+		return area.contains(x, y)
+	return area[0] <= x <= area[2] and area[1] <= y <= area[3]
+
+def scan(areas, x, y):
+	for (a, area) in enumerate(areas):
+		if inside(area, x, y):
+			return a
+	return -1
+
+def randomAreas(count, polygons=False):
+	areas = []
+	for k in range(count):
+		(x, y) = (rs.randint(0, 1000), rs.randint(0, 700))
+		(w, h) = (rs.randint(5, 120), rs.randint(5, 120))
+		if polygons and k % 4 == 0:
+			areas.append(Polygon([(x, y), (x + w, y), (x + w // 2, y + h)]))
+		else:
+			areas.append((x, y, x + w, y + h))
+	return areas
+
+x = rs.uniform(-20, 1044, 5000).round()
+y = rs.uniform(-20, 788, 5000).round()
+
+def compareIndex(areas):
+	expected = [scan(areas, px, py) for (px, py) in zip(x, y)]
+	index = AreaIndex(areas)
+	looked = [index.lookup(px, py) for (px, py) in zip(x, y)]
+	print " * %d areas, %d points in areas, lookup: %s, labels: %s" % (len(areas), sum(e >= 0 for e in expected),
+		looked == [e if e >= 0 else None for e in expected], list(index.labels(x, y)) == expected)
+
+areas = randomAreas(200)
+compareIndex(areas)
+
+stage = lambda s: AOI(s, 25, areas)
+print " * AOI: %d events, same: %s" % (len(perSample(stage, blocks[0])), all(perSample(stage, b) == blockMode(stage, b) for b in blocks))
+
+print "============= AOI polygon test ============"
+
+# An L shape: the notch at the top right is outside.
+shape = Polygon([(0, 0), (100, 0), (100, 50), (50, 50), (50, 100), (0, 100)])
+print " * L shape:", [shape.contains(px, py) for (px, py) in [(25, 25), (75, 25), (25, 75), (75, 75), (150, 50)]]
+print " * containsPoints: same: %s" % (list(shape.containsPoints(x / 8.0, y / 8.0)) == [shape.contains(px, py) for (px, py) in zip(x / 8.0, y / 8.0)])
+
+areas = randomAreas(200, polygons=True)
+compareIndex(areas)
+
+# TimedAreas against a scan of the epoch's areas, numbered in 'areas'.
+epochs = [(1000.0, areas[:80]), (2000.0, areas[60:140]), (3000.0, areas[120:])]
+timed = TimedAreas(epochs)
+t = rs.uniform(0.0, 4000.0, 5000)
+expected = []
+for (px, py, pt) in zip(x, y, t):
+	epoch = [e for e in epochs if e[0] <= pt]
+	a = scan(epoch[-1][1], px, py) if epoch else -1
+	expected.append(timed.areas.index(epoch[-1][1][a]) if a >= 0 else -1)
+looked = [timed.lookup(px, py, pt) for (px, py, pt) in zip(x, y, t)]
+print " * timed: %d areas, lookup: %s, labels: %s" % (len(timed.areas),
+	looked == [e if e >= 0 else None for e in expected], list(timed.labels(x, y, t)) == expected)
+
+timed = TimedAreas([(0.0, areas[:100]), (5.0, areas[100:])])
+stage = lambda s: AOI(s, 25, timed)
+print " * AOI: %d events, same: %s" % (len(perSample(stage, blocks[0])), all(perSample(stage, b) == blockMode(stage, b) for b in blocks))
+
+print "============= Synthetic recording test ============"
+
+a = synthesize(20000, seed=23)
+b = synthesize(20000, seed=23)
+c = synthesize(20000, seed=24)
+print " * seeded: same: %s, other seed differs: %s" % (all((a.columns[n] == b.columns[n]).all() for n in a.columns),
+	not (a.x == c.x).all())
+print " * %d samples, interval %s" % (len(a), sorted(set(np.diff(a.time))))
+print " * labels: %s" % dict((t, int((a.eventType == t).sum())) for t in np.unique(a.eventType))
+
+# Targets stay on the screen; tremor can take the gaze a pixel or so past
+# the edge.
+blink = a.eventType == 3
+(px, py) = (a.x[~blink], a.y[~blink])
+print " * blinks at (0, 0): %s, on screen otherwise: %s" % (((a.x[blink] == 0) & (a.y[blink] == 0)).all(),
+	((px > -5) & (px < 1029) & (py > -5) & (py < 773)).all())
+
+print "============= Evaluation test ============"
+
+from detect.evaluate import *
+
+# Events cover 'length' labelled samples from their first one, so the
+# first fixation overlaps the saccade, which wins as it starts later.
+samples = [Sample(i, i, 0, 0) for i in range(20)]
+events = [EFixation(samples[2], 4, samples[2], samples[5]), ESaccade(3, samples[6], samples[8]),
+          EFixation(samples[12], 5, samples[12], samples[16])]
+labels = eventLabels(events, np.array([0, 1, 2, 3, 5, 6, 7, 8, 9, 12, 13, 14, 15, 16, 17, 18]))
+print " * labels:", list(labels)
+
+truth = np.array([1, 1, 1, 2, 2, 0, 1, 1, 2, 1])
+predicted = np.array([1, 1, 2, 2, 0, 0, 1, 1, 2, 2])
+agreement = Agreement.fromLabels(truth, predicted)
+# 7 of 10 agree; by chance (1*2 + 6*4 + 3*4)/100 = 0.38.
+print " * agreement %.2f, kappa %.4f (expected %.4f)" % (agreement.agreement(), agreement.kappa(), (0.7 - 0.38) / (1 - 0.38))
+print " * sums: same: %s" % ((Agreement.fromLabels(truth[:4], predicted[:4]) + Agreement.fromLabels(truth[4:], predicted[4:])).matrix == agreement.matrix).all()
+
+clean = BlinkFilter(None).processBlock(synthesize(20000, seed=19, timeScale=1.0))
+sigma = tuple(medianSigma(np.column_stack(fivePointVelocity(clean))))
+print evaluate(EngbertKliegl(None, 6, sigma=sigma).processBlock(clean), clean)
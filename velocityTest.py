@@ -20,19 +20,18 @@
 #  of or in connection with the use or performance of this software.
 ###############################################################################
 
-from detect.sample import Sample
 from detect.sample import FileSampleStream
+from detect.sample import readSampleFile
 
-from detect.dispersion import *
 from detect.velocity import *
-from detect.hmm import *
-from detect.prefix import *
-from detect.aoi import *
 from detect.movingaverage import *
-from detect.srr import *
 from detect.intersamplevelocity import *
 from detect.sgfilter import *
 from detect.blinkfilter import *
+from detect.evaluate import *
+
+# The labels for the samples the detectors see, once blinks are removed.
+truth = BlinkFilter(None).processBlock(readSampleFile('testData/UH27_img_vy_labelled_MN.txt'))
 
 print "============= I-VT MovingAverage test ==============="
 
@@ -48,42 +47,7 @@ for i in idt:
 	print i
 	fixations.append(i)
 
-verifStream = BlinkFilter(FileSampleStream('testData/UH27_img_vy_labelled_MN.txt'))
-
-taggedEvents = []
-cfix = []
-eventType = []
-for i in verifStream:
-	if i.eventType == 1:
-		cfix.append(i)
-		eventType.append(1)
-	else:
-		eventType.append(0)
-		if len(cfix) == 0:
-			continue
-		print ("Fixation of length: " + str(len(cfix)) + " starting at sample " + str(cfix[0].index))
-		p = idt.centroid(cfix)
-
-		f = EFixation(p, len(cfix), cfix[0], cfix[-1])
-		taggedEvents.append(f)
-		cfix = []
-
-matchedSamples = 0
-errorSamples = 0
-
-for f in fixations:
-	s = f.start.index
-	for i in range(s,s+f.length):
-		if eventType[i] == 1:
-			matchedSamples = matchedSamples + 1
-		else:
-			errorSamples = errorSamples + 1
-
-mPct = matchedSamples / float(len(eventType))
-ePct = errorSamples / float(len(eventType))
-
-print "Matched Samples: " + str(matchedSamples) + " (" + str(mPct * 100) + "%)"
-print "Error Samples: " + str(errorSamples) + " (" + str(ePct * 100) + "%)"
+print evaluate(fixations, truth)
 
 print "============= I-VT SG test ==============="
 
@@ -99,41 +63,4 @@ for i in idt:
 	print i
 	fixations.append(i)
 
-verifStream = BlinkFilter(FileSampleStream('testData/UH27_img_vy_labelled_MN.txt'))
-
-taggedEvents = []
-cfix = []
-eventType = []
-for i in verifStream:
-	if i.eventType == 1:
-		cfix.append(i)
-		eventType.append(1)
-	else:
-		eventType.append(0)
-		if len(cfix) == 0:
-			continue
-		print ("Fixation of length: " + str(len(cfix)) + " starting at sample " + str(cfix[0].index))
-		p = idt.centroid(cfix)
-
-		f = EFixation(p, len(cfix), cfix[0], cfix[-1])
-		taggedEvents.append(f)
-		cfix = []
-
-matchedSamples = 0
-errorSamples = 0
-
-for f in fixations:
-	s = f.start.index
-	for i in range(s,s+f.length):
-		if eventType[i] == 1:
-			matchedSamples = matchedSamples + 1
-		else:
-			errorSamples = errorSamples + 1
-
-mPct = matchedSamples / float(len(eventType))
-ePct = errorSamples / float(len(eventType))
-
-print "Matched Samples: " + str(matchedSamples) + " (" + str(mPct * 100) + "%)"
-print "Error Samples: " + str(errorSamples) + " (" + str(ePct * 100) + "%)"
-
-
+print evaluate(fixations, truth)